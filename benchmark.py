@@ -0,0 +1,562 @@
+#!/usr/bin/env python3
+"""
+B-Transfer - Benchmarks
+Starts the server on localhost in a scratch directory and measures it.
+
+  python benchmark.py connections --engine threaded --engine asyncio
+  python benchmark.py connections --mode close --mode keep-alive --concurrency 20
+  python benchmark.py uploads --concurrency 8 --codec-pool off --codec-pool thread
+  python benchmark.py codecs --corpus ~/Documents
+  python benchmark.py --json before.json workload --concurrency 1 --concurrency 16
+  python benchmark.py workload --concurrency 1 --concurrency 16 --baseline before.json
+"""
+
+import os
+import sys
+import gzip
+import json
+import time
+import random
+import socket
+import shutil
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+import multiprocessing
+import urllib.request
+from urllib.parse import quote
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STATIC_FILES = ['index.html', 'manifest.json', 'sw.js']
+KEY_VARIABLES = ('BT_KEYS', 'BT_KEY_FILE', 'BT_CONFIG_DIR')
+
+def scratch_environ(workdir):
+    """os.environ with the server's keyring moved into workdir, away from the real one"""
+    env = {name: value for name, value in os.environ.items() if name not in KEY_VARIABLES}
+    env['BT_CONFIG_DIR'] = workdir
+    return env
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+class ServerProcess:
+    """Run server.py from a scratch directory so benchmarks never touch real data"""
+
+    def __init__(self, engine='threaded', env=None):
+        self.engine = engine
+        self.env = env or {}
+        self.port = free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        self.workdir = None
+        self.process = None
+
+    def __enter__(self):
+        self.workdir = tempfile.mkdtemp(prefix='b-transfer-bench-')
+        for name in STATIC_FILES:
+            shutil.copy(os.path.join(ROOT, name), self.workdir)
+        env = dict(scratch_environ(self.workdir), PORT=str(self.port), BT_ENGINE=self.engine, **self.env)
+        self.process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'server.py')], cwd=self.workdir,
+                                        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.time() + 15
+        while time.time() < deadline:
+            try:
+                urllib.request.urlopen(self.url + '/health', timeout=1).read()
+                return self
+            except OSError:
+                time.sleep(0.1)
+        self.__exit__()
+        raise RuntimeError(f"server ({self.engine}) did not start")
+
+    def peak_rss_mb(self):
+        """Peak resident memory of the server process so far (Linux only, else None)"""
+        try:
+            with open(f'/proc/{self.process.pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return round(int(line.split()[1]) / 1024, 1)
+        except OSError:
+            pass
+        return None
+
+    def __exit__(self, *exc):
+        if self.process:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        if self.workdir:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def upload(self, name, data):
+        boundary = 'benchboundary7a1c'
+        body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\n\r\n'.encode()
+                + data + f'\r\n--{boundary}--\r\n'.encode())
+        request = urllib.request.Request(self.url + '/upload', data=body,
+                                         headers={'Content-Type': f'multipart/form-data; boundary={boundary}'})
+        return json.loads(urllib.request.urlopen(request).read())
+
+async def _read_response(reader):
+    """Read one Content-Length framed response. Returns (status line, server closes the connection)"""
+    status_line = await reader.readline()
+    length, closing = 0, False
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+        elif name.strip().lower() == 'connection' and value.strip().lower() == 'close':
+            closing = True
+    await reader.readexactly(length)
+    return status_line, closing
+
+async def _fetch_loop(port, path, stop_at, latencies, errors, keep_alive=False):
+    """Request path until stop_at, on a new connection each time or on one kept-alive connection"""
+    connection = 'keep-alive' if keep_alive else 'close'
+    request = f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: {connection}\r\n\r\n'.encode()
+    reader = writer = None
+    while time.perf_counter() < stop_at:
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(request)
+            status_line, closing = await _read_response(reader)
+            if closing or not keep_alive:
+                writer.close()
+                writer = None
+            if b' 200 ' not in status_line:
+                errors[0] += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            errors[0] += 1
+            if writer is not None:
+                writer.close()
+                writer = None
+            await asyncio.sleep(0.01)
+    if writer is not None:
+        writer.close()
+
+def _client_process(port, path, concurrency, duration, keep_alive=False):
+    """One load generating process: concurrency connections in a loop for duration seconds"""
+    latencies = []
+    errors = [0]
+
+    async def run():
+        stop_at = time.perf_counter() + duration
+        await asyncio.gather(*(_fetch_loop(port, path, stop_at, latencies, errors, keep_alive)
+                               for _ in range(concurrency)))
+
+    asyncio.run(run())
+    return latencies, errors[0]
+
+def run_connection_load(port, path, concurrency, duration, client_procs, keep_alive=False):
+    """Return requests/s and latency percentiles, with a new connection per request unless keep_alive"""
+    per_proc = [concurrency // client_procs + (1 if i < concurrency % client_procs else 0)
+                for i in range(client_procs)]
+    with multiprocessing.Pool(client_procs) as pool:
+        results = pool.starmap(_client_process, [(port, path, n, duration, keep_alive) for n in per_proc if n])
+    latencies = sorted(l for result in results for l in result[0])
+    errors = sum(result[1] for result in results)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'requests_per_sec': round(len(latencies) / duration, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+def bench_connections(args):
+    """Request rate and latency of cheap polling routes, per engine and connection mode"""
+    results = []
+    for engine in args.engine or ['threaded', 'asyncio']:
+        with ServerProcess(engine) as server:
+            for i in range(args.files):
+                server.upload(f'seed-{i}.txt', b'benchmark seed file\n' * 100)
+            # Warm up caches and the interpreter before measuring
+            run_connection_load(server.port, args.path, min(args.concurrency, 10), 1, 1)
+            for mode in args.mode or ['close', 'keep-alive']:
+                result = run_connection_load(server.port, args.path, args.concurrency, args.duration,
+                                             args.client_procs, keep_alive=mode == 'keep-alive')
+                result.update(engine=engine, mode=mode, path=args.path, concurrency=args.concurrency)
+                results.append(result)
+                print(f"{engine:>9} {mode:>10} {args.path}: {result['requests_per_sec']:>8} req/s  "
+                      f"p50 {result['p50_ms']} ms  p99 {result['p99_ms']} ms  errors {result['errors']}")
+    return results
+
+def sample_data(size):
+    """size bytes, half text and half random, so compression has something but not everything to do"""
+    text = (b'The quick brown fox jumps over the lazy dog. 0123456789\n' * (size // 112 + 1))[:size // 2]
+    return text + os.urandom(size - len(text))
+
+def _upload_worker(url, size, count, name):
+    """Upload count files of size bytes (half text, half random) and return the bytes sent"""
+    boundary = 'benchboundary7a1c'
+    data = sample_data(size)
+    head = f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}.txt"\r\n\r\n'.encode()
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+    for _ in range(count):
+        request = urllib.request.Request(url + '/upload', data=head + data + tail,
+                                         headers={'Content-Type': f'multipart/form-data; boundary={boundary}'})
+        urllib.request.urlopen(request).read()
+    return size * count
+
+def bench_uploads(args):
+    """Aggregate upload MB/s for concurrent uploads, per codec pool setting"""
+    results = []
+    for pool_kind in args.codec_pool or ['off', 'thread', 'process']:
+        env = {'BT_CODEC_POOL': pool_kind}
+        if args.codec_workers:
+            env['BT_CODEC_WORKERS'] = str(args.codec_workers)
+        with ServerProcess(args.engine, env) as server:
+            size = int(args.size_mb * 1024 * 1024)
+            with multiprocessing.Pool(args.concurrency) as pool:
+                start = time.perf_counter()
+                sent = sum(pool.starmap(_upload_worker, [(server.url, size, args.count, f'up-{i}')
+                                                         for i in range(args.concurrency)]))
+                elapsed = time.perf_counter() - start
+            result = {'codec_pool': pool_kind, 'concurrency': args.concurrency, 'size_mb': args.size_mb,
+                      'seconds': round(elapsed, 2), 'mb_per_sec': round(sent / elapsed / 1e6, 1)}
+            results.append(result)
+            print(f"{pool_kind:>8} pool, {args.concurrency} concurrent uploads of {args.size_mb} MB: "
+                  f"{result['mb_per_sec']} MB/s")
+    return results
+
+def synthetic_corpus(size):
+    """A mix of the kinds of files people send: text, data, binaries and media"""
+    rng = random.Random(1)
+    source = b''.join(open(os.path.join(ROOT, name), 'rb').read() for name in ['server.py', 'index.html', 'README.md'])
+    log_lines = [f"2024-05-01T10:{i // 60 % 60:02d}:{i % 60:02d} INFO worker-{rng.randint(1, 16)} "
+                 f"GET /api/items/{rng.randint(1, 99999)} 200 {rng.randint(1, 900)}ms\n" for i in range(size // 60)]
+    log = ''.join(log_lines).encode()[:size]
+    csv = ''.join(f"{i},{rng.random():.6f},{rng.choice('abc')},{rng.randint(0, 10 ** 9)}\n"
+                  for i in range(size // 30)).encode()[:size]
+    samples = bytes(rng.getrandbits(8) >> rng.randint(2, 8) for _ in range(size))  # Skewed binary, like audio
+    return {
+        'source.txt': (source * (size // len(source) + 1))[:size],
+        'server.log': log,
+        'table.csv': csv,
+        'samples.raw': samples,
+        'sparse.img': bytes(size // 2) + os.urandom(size // 4) + bytes(size - size // 2 - size // 4),
+        'archive.gz': gzip.compress(log + csv, 6)[:size],
+        'video.webm': b'\x1a\x45\xdf\xa3' + os.urandom(size - 4),
+        'random.bin': os.urandom(size),
+    }
+
+def load_corpus(paths):
+    corpus = {}
+    for path in paths:
+        names = [os.path.join(root, name) for root, _, files in os.walk(path) for name in files] \
+            if os.path.isdir(path) else [path]
+        for name in sorted(names):
+            with open(name, 'rb') as f:
+                corpus[os.path.relpath(name, path) if os.path.isdir(path) else os.path.basename(name)] = f.read()
+    return corpus
+
+def bench_codecs(args):
+    """CPU time against bytes saved for each codec and compression policy over a corpus"""
+    # server.py opens its databases in the working directory and its keyring on import
+    workdir = tempfile.mkdtemp(prefix='b-transfer-bench-')
+    os.chdir(workdir)
+    for name in KEY_VARIABLES:
+        os.environ.pop(name, None)
+    os.environ['BT_CONFIG_DIR'] = workdir
+    sys.path.insert(0, ROOT)
+    import server
+
+    corpus = load_corpus(args.corpus) if args.corpus else synthetic_corpus(int(args.size_mb * 1024 * 1024))
+    size = server.SEGMENT_SIZE
+
+    def segments(data):
+        return [data[i:i + size] for i in range(0, len(data), size)] or [b'']
+
+    def fixed(codec, level):
+        return lambda data: [server.compress_segment(s, codec, level) for s in segments(data)]
+
+    def policy(name):
+        def run(data):
+            parts = segments(data)
+            codec, level = server.choose_codec(parts[0], name)
+            return [server.compress_segment(s, codec, level) for s in parts]
+        return run
+
+    candidates = {
+        'gzip whole file (old)': lambda data: [gzip.compress(data)],
+        'store': fixed(server.CODEC_STORE, 0),
+        'deflate 1': fixed(server.CODEC_DEFLATE, 1),
+        'deflate 6': fixed(server.CODEC_DEFLATE, 6),
+        'deflate 9': fixed(server.CODEC_DEFLATE, 9),
+        'lzma 0': fixed(server.CODEC_LZMA, 0),
+        'lzma 6': fixed(server.CODEC_LZMA, 6),
+    }
+    candidates.update((f'policy {name}', policy(name)) for name in ('auto', 'fast', 'max'))
+
+    total_in = sum(len(data) for data in corpus.values())
+    print(f"Corpus: {len(corpus)} files, {total_in / 1e6:.1f} MB")
+    for name, data in corpus.items():
+        print(f"  {name}: {len(data) / 1e6:.1f} MB, auto picks {'/'.join(map(str, server.choose_codec(data[:size], 'auto')))}")
+    results = []
+    for label, compress in candidates.items():
+        cpu = stored = 0
+        for data in corpus.values():
+            start = time.process_time()
+            stored += sum(len(part) for part in compress(data))
+            cpu += time.process_time() - start
+        result = {'codec': label, 'cpu_seconds': round(cpu, 3), 'mb_per_cpu_sec': round(total_in / max(cpu, 1e-9) / 1e6, 1),
+                  'saved_percent': round((1 - stored / total_in) * 100, 1)}
+        results.append(result)
+        print(f"{label:>22}: {result['cpu_seconds']:>7.2f} CPU s  {result['mb_per_cpu_sec']:>7} MB/s  "
+              f"saved {result['saved_percent']}%")
+    return results
+
+WORKLOAD_OPS = ('upload', 'download', 'list', 'preview', 'range')
+
+def parse_size(value):
+    """'512', '64K', '8M' or '1G' as bytes"""
+    value = value.strip().upper()
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+def parse_weights(spec, parse_key=str):
+    """'a=3,b=1' as [(key, weight)]"""
+    weights = []
+    for item in spec.split(','):
+        key, _, weight = item.partition('=')
+        weights.append((parse_key(key.strip()), float(weight or 1)))
+    return weights
+
+def _workload_client(port, files, mix, sizes, threads, duration, range_size, seed):
+    """One load generating process: threads clients, each on its own kept-alive connection,
+    sending operations drawn from mix until duration is up. Returns [(op, seconds, bytes, ok)]"""
+    samples = []
+    payloads = {}
+    payload_lock = threading.Lock()
+    boundary = 'benchboundary7a1c'
+    stop_at = time.perf_counter() + duration
+
+    def payload(size):
+        with payload_lock:
+            if size not in payloads:
+                payloads[size] = sample_data(size)
+            return payloads[size]
+
+    def client(index):
+        rng = random.Random(seed * 1000 + index)
+        ops, op_weights = zip(*mix)
+        size_values, size_weights = zip(*sizes)
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+        sent = 0
+        while time.perf_counter() < stop_at:
+            op = rng.choices(ops, op_weights)[0]
+            name, file_size = rng.choice(files)
+            method, path, body, headers = 'GET', f'/download/{quote(name)}', None, {}
+            if op == 'upload':
+                sent += 1
+                data = payload(rng.choices(size_values, size_weights)[0])
+                head = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; '
+                        f'filename="load-{seed}-{index}-{sent}.bin"\r\n\r\n').encode()
+                tail = f'\r\n--{boundary}--\r\n'.encode()
+                # A list body is sent piece by piece, so large uploads are never copied
+                method, path, body = 'POST', '/upload', [head, data, tail]
+                headers = {'Content-Type': f'multipart/form-data; boundary={boundary}',
+                           'Content-Length': str(len(head) + len(data) + len(tail))}
+            elif op == 'list':
+                path = '/files'
+            elif op == 'preview':
+                path = f'/preview/{quote(name)}'
+            elif op == 'range':
+                start = rng.randrange(max(1, file_size - range_size))
+                headers = {'Range': f'bytes={start}-{start + range_size - 1}'}
+            started = time.perf_counter()
+            moved = 0
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                while True:
+                    chunk = response.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    moved += len(chunk)
+                ok = response.status in (200, 206)
+                if op == 'upload':
+                    moved = len(data)
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                ok = False
+            samples.append((op, time.perf_counter() - started, moved, ok))
+        conn.close()
+
+    workers = [threading.Thread(target=client, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return samples
+
+def summarize_workload(samples, duration):
+    """Throughput and latency percentiles per operation and for all of them together"""
+    rows = []
+    for op in WORKLOAD_OPS + ('all',):
+        chosen = [s for s in samples if op in ('all', s[0])]
+        if not chosen:
+            continue
+        latencies = sorted(s[1] for s in chosen if s[3])
+        rows.append({
+            'op': op,
+            'requests': len(latencies),
+            'errors': len(chosen) - len(latencies),
+            'ops_per_sec': round(len(latencies) / duration, 1),
+            'mb_per_sec': round(sum(s[2] for s in chosen if s[3]) / duration / 1e6, 1),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        })
+    return rows
+
+def bench_workload(args):
+    """Mixed uploads, downloads, listings, previews and range seeks at each concurrency level.
+
+    Every run gets a fresh server seeded with files drawn from the size
+    distribution, so its peak RSS belongs to that run alone.
+    """
+    mix = [(op, weight) for op, weight in parse_weights(args.mix) if weight > 0]
+    unknown = [op for op, _ in mix if op not in WORKLOAD_OPS]
+    if unknown or not mix:
+        raise SystemExit(f"--mix takes {', '.join(WORKLOAD_OPS)}; got {args.mix}")
+    sizes = parse_weights(args.sizes, parse_size)
+    range_size = parse_size(args.range_size)
+    rng = random.Random(args.seed)
+    results = []
+    for engine in args.engine or ['threaded']:
+        for concurrency in args.concurrency or [1, 8, 32]:
+            with ServerProcess(engine) as server:
+                files = []
+                for i in range(args.files):
+                    size = rng.choices(*zip(*sizes))[0]
+                    files.append((server.upload(f'seed-{i}.bin', sample_data(size))['filename'], size))
+                procs = max(1, min(args.client_procs, concurrency))
+                per_proc = [concurrency // procs + (1 if i < concurrency % procs else 0) for i in range(procs)]
+                with multiprocessing.Pool(procs) as pool:
+                    start = time.perf_counter()
+                    runs = pool.starmap(_workload_client, [(server.port, files, mix, sizes, n, args.duration,
+                                                            range_size, args.seed + i)
+                                                           for i, n in enumerate(per_proc)])
+                    elapsed = time.perf_counter() - start
+                peak_rss = server.peak_rss_mb()
+            for row in summarize_workload([s for run in runs for s in run], elapsed):
+                row.update(engine=engine, concurrency=concurrency, peak_rss_mb=peak_rss)
+                results.append(row)
+                print(f"{engine:>9} x{concurrency:<4} {row['op']:>8}: {row['ops_per_sec']:>8} op/s "
+                      f"{row['mb_per_sec']:>8} MB/s  p50 {row['p50_ms']} ms  p95 {row['p95_ms']} ms  "
+                      f"p99 {row['p99_ms']} ms  errors {row['errors']}")
+            print(f"{engine:>9} x{concurrency:<4} peak RSS {peak_rss} MB")
+    if args.baseline:
+        args.failed = bool(compare_baseline(results, args.baseline, args.tolerance))
+    return results
+
+def compare_baseline(results, path, tolerance):
+    """Print each result's change against the same run in a saved --json file. Returns the regressions"""
+    with open(path) as f:
+        baseline = {(r['engine'], r['concurrency'], r['op']): r for r in json.load(f) if 'op' in r}
+    regressions = []
+    print(f"Compared with {path} (regression: worse by more than {tolerance}%)")
+    for result in results:
+        before = baseline.get((result['engine'], result['concurrency'], result['op']))
+        if before is None:
+            continue
+        changes = []
+        for metric, higher_is_better in (('ops_per_sec', True), ('p50_ms', False), ('p95_ms', False),
+                                         ('p99_ms', False), ('peak_rss_mb', False)):
+            old, new = before.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            regressed = (-change if higher_is_better else change) > tolerance
+            if regressed:
+                regressions.append((result['engine'], result['concurrency'], result['op'], metric))
+            changes.append(f"{metric} {old} -> {new} ({change:+.1f}%{' REGRESSION' if regressed else ''})")
+        print(f"{result['engine']:>9} x{result['concurrency']:<4} {result['op']:>8}: {', '.join(changes)}")
+    print(f"{len(regressions)} regression(s)")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="B-Transfer benchmarks")
+    parser.add_argument('--json', help="also write results to this file")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    connections = commands.add_parser('connections', help="connection rate and latency per server engine")
+    connections.add_argument('--engine', action='append', choices=['threaded', 'asyncio'],
+                             help="engine to test (repeatable, default: both)")
+    connections.add_argument('--mode', action='append', choices=['close', 'keep-alive'],
+                             help="new connection per request or one per client (repeatable, default: both)")
+    connections.add_argument('--path', default='/files', help="route to request (default: /files)")
+    connections.add_argument('--concurrency', type=int, default=200, help="concurrent clients (default: 200)")
+    connections.add_argument('--duration', type=float, default=10, help="seconds per run (default: 10)")
+    connections.add_argument('--files', type=int, default=20, help="files to seed before measuring (default: 20)")
+    connections.add_argument('--client-procs', type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                             help="load generator processes (default: half the CPUs)")
+    connections.set_defaults(func=bench_connections)
+
+    uploads = commands.add_parser('uploads', help="aggregate upload throughput per codec pool setting")
+    uploads.add_argument('--codec-pool', action='append', choices=['off', 'thread', 'process'],
+                         help="codec pool to test (repeatable, default: all)")
+    uploads.add_argument('--codec-workers', type=int, help="codec pool size (default: server default)")
+    uploads.add_argument('--engine', default='threaded', choices=['threaded', 'asyncio'])
+    uploads.add_argument('--concurrency', type=int, default=4, help="parallel uploads (default: 4)")
+    uploads.add_argument('--size-mb', type=float, default=64, help="size of each upload (default: 64)")
+    uploads.add_argument('--count', type=int, default=2, help="uploads per client (default: 2)")
+    uploads.set_defaults(func=bench_uploads)
+
+    codecs = commands.add_parser('codecs', help="CPU time against bytes saved per codec over a corpus")
+    codecs.add_argument('--corpus', action='append', help="file or directory to use (repeatable, default: synthetic)")
+    codecs.add_argument('--size-mb', type=float, default=4, help="size of each synthetic file (default: 4)")
+    codecs.set_defaults(func=bench_codecs)
+
+    workload = commands.add_parser('workload', help="throughput, latency and memory under a mix of transfer operations")
+    workload.add_argument('--engine', action='append', choices=['threaded', 'asyncio'],
+                          help="engine to test (repeatable, default: threaded)")
+    workload.add_argument('--concurrency', type=int, action='append',
+                          help="concurrent clients (repeatable, default: 1, 8 and 32)")
+    workload.add_argument('--mix', default='download=4,list=3,range=2,upload=1,preview=1',
+                          help=f"operation weights from {', '.join(WORKLOAD_OPS)} "
+                               "(default: download=4,list=3,range=2,upload=1,preview=1)")
+    workload.add_argument('--sizes', default='16K=40,256K=30,4M=25,32M=5',
+                          help="file size distribution as size=weight (default: 16K=40,256K=30,4M=25,32M=5)")
+    workload.add_argument('--range-size', default='64K', help="bytes per range request (default: 64K)")
+    workload.add_argument('--files', type=int, default=20, help="files to seed before measuring (default: 20)")
+    workload.add_argument('--duration', type=float, default=15, help="seconds per run (default: 15)")
+    workload.add_argument('--client-procs', type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                          help="load generator processes (default: half the CPUs)")
+    workload.add_argument('--seed', type=int, default=1, help="random seed for sizes and operations (default: 1)")
+    workload.add_argument('--baseline', help="--json file of an earlier run to compare against")
+    workload.add_argument('--tolerance', type=float, default=10,
+                          help="percent a metric may worsen before it counts as a regression (default: 10)")
+    workload.set_defaults(func=bench_workload)
+
+    args = parser.parse_args()
+    results = args.func(args)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if getattr(args, 'failed', False):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -12,35 +12,294 @@ import gzip
 import io
 import sqlite3
 import struct
-from datetime import datetime, timedelta
+import zlib
+import math
+import lzma
+from datetime import datetime, timedelta, timezone
 from urllib.parse import unquote, parse_qs
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from socketserver import ThreadingMixIn
-import cgi
+import email.parser
+import email.utils
 import shutil
 import mimetypes
-from cryptography.fernet import Fernet
+import argparse
+import asyncio
+import collections
+import heapq
+import bisect
+import queue
+import signal
+import atexit
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from cryptography.fernet import Fernet, MultiFernet
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
 class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
     """Handle requests in a separate thread."""
-    pass
+    daemon_threads = True  # Idle keep-alive connections must not hold up shutdown
+    request_queue_size = 128  # Listen backlog
 
+    def __init__(self, server_address, RequestHandlerClass, reuse_port=False):
+        # Prefork workers each bind their own socket to the same port
+        self.allow_reuse_port = reuse_port
+        self.connections = 0
+        self.connections_lock = threading.Lock()
+        super().__init__(server_address, RequestHandlerClass)
 
-# Key generation for encryption purposes
-KEY = base64.urlsafe_b64encode(os.urandom(32))
-fernet = Fernet(KEY)
+    def process_request(self, request, client_address):
+        """Start a thread for the connection, or turn it away once MAX_CONNECTIONS are open"""
+        with self.connections_lock:
+            accept = self.connections < MAX_CONNECTIONS
+            if accept:
+                self.connections += 1
+        if not accept:
+            try:
+                request.settimeout(1)
+                request.sendall(BUSY_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        super().process_request(request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            with self.connections_lock:
+                self.connections -= 1
+
+
+# Encryption keys
+#
+# Keys persist across restarts so stored files stay readable. They come from
+# $BT_KEYS (comma separated) or else from the key file, which is created with
+# a fresh key on first start. The first key encrypts new files; the others are
+# kept to read files written before a rotation. Every file and upload session
+# records the id of the key it was sealed with. The key file lives in a
+# private config directory, away from anything the server serves.
+CONFIG_DIR = os.environ.get('BT_CONFIG_DIR', os.path.join(os.path.expanduser('~'), '.config', 'b-transfer'))
+KEY_FILE = os.environ.get('BT_KEY_FILE', os.path.join(CONFIG_DIR, 'b-transfer.key'))
+
+def key_id(key):
+    """Identify a key without revealing it"""
+    return hashlib.sha256(key).hexdigest()[:16]
+
+def load_keys():
+    """Return the encryption keys, newest first"""
+    if os.environ.get('BT_KEYS'):
+        keys = [key.strip().encode() for key in os.environ['BT_KEYS'].split(',') if key.strip()]
+    else:
+        os.makedirs(os.path.dirname(KEY_FILE) or '.', mode=0o700, exist_ok=True)
+        try:
+            fd = os.open(KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(base64.urlsafe_b64encode(os.urandom(32)) + b'\n')
+            print(f"🔑 Created encryption key file: {KEY_FILE}")
+        except FileExistsError:
+            pass
+        with open(KEY_FILE, 'rb') as f:
+            keys = [line.strip() for line in f if line.strip()]
+    for key in keys:
+        try:
+            valid = len(base64.urlsafe_b64decode(key)) == 32
+        except ValueError:
+            valid = False
+        if not valid:
+            raise ValueError("Encryption keys must be 32 bytes, urlsafe base64 encoded")
+    if not keys:
+        raise ValueError("No encryption key configured")
+    return keys
+
+def rotate_key():
+    """Put a new key at the front of the key file, keeping the old ones for reading. Returns its id"""
+    if os.environ.get('BT_KEYS'):
+        raise ValueError("Keys come from $BT_KEYS; add the new key at the front of it instead")
+    key = base64.urlsafe_b64encode(os.urandom(32))
+    temp_path = f"{KEY_FILE}.{uuid.uuid4().hex}.tmp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(b'\n'.join([key] + KEYS) + b'\n')
+    os.replace(temp_path, KEY_FILE)
+    return key_id(key)
+
+KEYS = load_keys()
+KEY = KEYS[0]
+KEY_ID = key_id(KEY)
+KEYRING = {key_id(key): key for key in KEYS}
+fernet = MultiFernet([Fernet(key) for key in KEYS])  # Legacy files: tries each key
+
+# Metrics
+#
+# GET /metrics reports counters, gauges and histograms in the Prometheus text
+# format. Every thread records into its own shard, a dict no other thread
+# writes to, so recording takes no lock; a scrape adds the shards up, folding
+# those of exited threads into one. Gauges that mirror existing state (lanes,
+# connections, threads) are read only when scraped. Each process keeps its own
+# numbers: with --processes a scrape is answered by whichever worker accepts
+# it, and timings of codec jobs run by a 'process' codec pool are not seen.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+STAGE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0, 1.1)
+SWEEP_BUCKETS = (0.01, 0.1, 1, 10, 60, 300)
+
+class Metrics:
+    """Registry of metric families whose values are kept in per-thread shards"""
+
+    def __init__(self):
+        self.families = {}  # name -> {'kind', 'help', 'labels', 'bounds', 'collect'}
+        self.local = threading.local()
+        self.shards = []  # (thread, values)
+        self.retired = {}  # Values recorded by threads that have exited
+        self.lock = threading.Lock()
+
+    def register(self, kind, name, help, labels=(), bounds=None, collect=None):
+        """collect, if given, returns [(label values, value)] at scrape time instead of recorded values"""
+        self.families[name] = {'kind': kind, 'help': help, 'labels': labels, 'bounds': bounds, 'collect': collect}
+
+    def shard(self):
+        try:
+            return self.local.values
+        except AttributeError:
+            values = self.local.values = {}
+            with self.lock:
+                self.shards.append((threading.current_thread(), values))
+            return values
+
+    def inc(self, name, labels=(), amount=1):
+        values = self.shard()
+        key = (name, labels)
+        values[key] = values.get(key, 0) + amount
+
+    def observe(self, name, value, labels=()):
+        values = self.shard()
+        key = (name, labels)
+        buckets = values.get(key)
+        bounds = self.families[name]['bounds']
+        if buckets is None:
+            # A count per bound, then +Inf, sum and count
+            buckets = values[key] = [0] * (len(bounds) + 3)
+        buckets[bisect.bisect_left(bounds, value)] += 1
+        buckets[-2] += value
+        buckets[-1] += 1
+
+    @staticmethod
+    def merge(totals, items):
+        for key, value in items:
+            if isinstance(value, list):
+                total = totals.get(key)
+                if total is None:
+                    totals[key] = list(value)
+                else:
+                    for i, v in enumerate(value):
+                        total[i] += v
+            else:
+                totals[key] = totals.get(key, 0) + value
+
+    def collect(self):
+        """Sum all shards. Returns {(name, label values): value or bucket counts}"""
+        totals = {}
+        with self.lock:
+            live = []
+            for thread, values in self.shards:
+                if thread.is_alive():
+                    live.append((thread, values))
+                else:
+                    self.merge(self.retired, values.items())
+            self.shards = live
+            self.merge(totals, self.retired.items())
+            for _, values in live:
+                # list() copies the items in one step while the owner keeps writing
+                self.merge(totals, list(values.items()))
+        return totals
+
+    def render(self):
+        """Every family in the Prometheus text exposition format"""
+        samples = collections.defaultdict(list)
+        for (name, labels), value in self.collect().items():
+            samples[name].append((labels, value))
+        lines = []
+        for name, family in self.families.items():
+            lines.append(f'# HELP {name} {family["help"]}')
+            lines.append(f'# TYPE {name} {family["kind"]}')
+            values = family['collect']() if family['collect'] else samples[name]
+            if not values and not family['labels'] and family['kind'] != 'histogram':
+                values = [((), 0)]
+            for labels, value in sorted(values, key=lambda sample: [str(v) for v in sample[0]]):
+                if family['kind'] != 'histogram':
+                    lines.append(f'{name}{metric_labels(family["labels"], labels)} {value}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(family['bounds'] + ('+Inf',), value):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{metric_labels(family["labels"] + ("le",), labels + (bound,))} '
+                                 f'{cumulative}')
+                lines.append(f'{name}_sum{metric_labels(family["labels"], labels)} {value[-2]}')
+                lines.append(f'{name}_count{metric_labels(family["labels"], labels)} {value[-1]}')
+        return '\n'.join(lines) + '\n'
+
+def metric_labels(names, values):
+    """Format labels as {name="value",...}"""
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+metrics = Metrics()
+metrics.register('counter', 'bt_requests_total', 'Requests served', ('route', 'method', 'status'))
+metrics.register('histogram', 'bt_request_duration_seconds', 'Time from request head to the end of the response',
+                 ('route',), LATENCY_BUCKETS)
+metrics.register('gauge', 'bt_requests_in_flight', 'Requests being served')
+metrics.register('counter', 'bt_received_bytes_total', 'Request body bytes received')
+metrics.register('counter', 'bt_sent_bytes_total', 'Response body bytes sent')
+metrics.register('histogram', 'bt_upload_stage_seconds',
+                 'Upload time per stage, per segment (per 64 KiB read for parse)', ('stage',), STAGE_BUCKETS)
+metrics.register('histogram', 'bt_download_stage_seconds',
+                 'Download time per stage, per segment (per 64 KiB write for send)', ('stage',), STAGE_BUCKETS)
+metrics.register('histogram', 'bt_compression_ratio', 'Stored size over original size of uploaded files',
+                 bounds=RATIO_BUCKETS)
+metrics.register('histogram', 'bt_housekeeping_seconds', 'Duration of sweeps for stale sessions and orphaned blobs',
+                 bounds=SWEEP_BUCKETS)
+metrics.register('counter', 'bt_expired_files_total', 'Files deleted at their expiry')
+metrics.register('gauge', 'bt_threads', 'Live threads in this process',
+                 collect=lambda: [((), threading.active_count())])
 
 # Advanced Analytics Database
+#
+# Request threads only put events on a queue. A single writer thread owns a
+# long-lived WAL connection and applies the queued events in batches, one
+# transaction per batch, so no request waits on SQLite's lock or fsync.
+#
+# The same transactions keep rollup tables (running totals, per-day and
+# per-type counters) current, so statistics never scan the raw upload rows.
+# Raw rows older than the retention period are deleted; the rollups keep
+# counting them.
+ANALYTICS_BATCH_SIZE = 500  # Events per transaction at most
+ANALYTICS_FLUSH_INTERVAL = 1.0  # Seconds an event may wait before being written
+ANALYTICS_QUEUE_SIZE = 100000  # Events beyond this are dropped rather than block a request
+ANALYTICS_RETENTION_DAYS = 30  # Raw upload rows are kept this long
+ANALYTICS_COMPACT_INTERVAL = 3600  # Seconds between retention passes
+
 class AnalyticsDB:
     def __init__(self):
         self.db_path = 'analytics.db'
+        self.events = queue.Queue(maxsize=ANALYTICS_QUEUE_SIZE)
+        self.dropped = 0
+        self.writer = None
         self.init_db()
     
     def init_db(self):
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
+        # WAL lets the request threads read while the writer thread writes
+        cursor.execute('PRAGMA journal_mode=WAL')
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS uploads (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -53,41 +312,118 @@ class AnalyticsDB:
                 download_count INTEGER DEFAULT 0
             )
         ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_uploads_filename ON uploads (filename)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_uploads_time ON uploads (upload_time)')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS upload_totals (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                files INTEGER,
+                total_size INTEGER,
+                total_compressed INTEGER
+            )
+        ''')
+        cursor.execute('CREATE TABLE IF NOT EXISTS upload_days (day TEXT PRIMARY KEY, uploads INTEGER, total_size INTEGER)')
+        cursor.execute('CREATE TABLE IF NOT EXISTS upload_types (file_type TEXT PRIMARY KEY, uploads INTEGER)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_upload_types_uploads ON upload_types (uploads)')
+
+        # Databases from before the rollups existed are counted once, here
+        cursor.execute('SELECT COUNT(*) FROM upload_totals')
+        if cursor.fetchone()[0] == 0:
+            cursor.execute('''
+                INSERT INTO upload_totals
+                SELECT 1, COUNT(*), COALESCE(SUM(file_size), 0), COALESCE(SUM(compressed_size), 0) FROM uploads
+            ''')
+            cursor.execute('''
+                INSERT INTO upload_days
+                SELECT DATE(upload_time), COUNT(*), COALESCE(SUM(file_size), 0) FROM uploads GROUP BY DATE(upload_time)
+            ''')
+            cursor.execute('INSERT INTO upload_types SELECT file_type, COUNT(*) FROM uploads GROUP BY file_type')
         conn.commit()
         conn.close()
     
+    def start(self):
+        """Start the writer thread; events queued before this are written too"""
+        self.writer = AnalyticsWriter(self)
+        self.writer.daemon = True
+        self.writer.start()
+        atexit.register(self.close)
+    
+    def close(self):
+        """Write every queued event and stop the writer thread"""
+        if self.writer is not None and self.writer.is_alive():
+            self.events.put(None)
+            self.writer.join()
+    
+    def record(self, event):
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+    
     def log_upload(self, filename, file_size, file_type, ip_address, compressed_size):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO uploads (filename, file_size, file_type, upload_time, ip_address, compressed_size)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (filename, file_size, file_type, datetime.now(), ip_address, compressed_size))
-        conn.commit()
-        conn.close()
+        self.record(('upload', (filename, file_size, file_type, datetime.now(), ip_address, compressed_size)))
     
     def increment_download(self, filename):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('UPDATE uploads SET download_count = download_count + 1 WHERE filename = ?', (filename,))
-        conn.commit()
-        conn.close()
+        self.record(('download', filename))
+    
+    def write_events(self, conn, events):
+        """Apply a batch of queued events in one transaction"""
+        uploads = [args for kind, args in events if kind == 'upload']
+        downloads = collections.Counter(args for kind, args in events if kind == 'download')
+        days = collections.defaultdict(lambda: [0, 0])
+        types = collections.Counter()
+        for _filename, file_size, file_type, upload_time, _ip, _compressed in uploads:
+            days[upload_time.date().isoformat()][0] += 1
+            days[upload_time.date().isoformat()][1] += file_size
+            types[file_type] += 1
+        with conn:
+            conn.executemany('''
+                INSERT INTO uploads (filename, file_size, file_type, upload_time, ip_address, compressed_size)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', uploads)
+            conn.executemany('UPDATE uploads SET download_count = download_count + ? WHERE filename = ?',
+                             [(count, filename) for filename, count in downloads.items()])
+            if uploads:
+                conn.execute('''
+                    UPDATE upload_totals SET files = files + ?, total_size = total_size + ?,
+                        total_compressed = total_compressed + ?
+                    WHERE id = 1
+                ''', (len(uploads), sum(u[1] for u in uploads), sum(u[5] or 0 for u in uploads)))
+                conn.executemany('''
+                    INSERT INTO upload_days (day, uploads, total_size) VALUES (?, ?, ?)
+                    ON CONFLICT (day) DO UPDATE SET uploads = uploads + excluded.uploads,
+                        total_size = total_size + excluded.total_size
+                ''', [(day, count, size) for day, (count, size) in days.items()])
+                conn.executemany('''
+                    INSERT INTO upload_types (file_type, uploads) VALUES (?, ?)
+                    ON CONFLICT (file_type) DO UPDATE SET uploads = uploads + excluded.uploads
+                ''', types.items())
+    
+    def compact(self, conn):
+        """Delete raw upload rows past the retention period. Returns how many went"""
+        cutoff = datetime.now() - timedelta(days=ANALYTICS_RETENTION_DAYS)
+        with conn:
+            removed = conn.execute('DELETE FROM uploads WHERE upload_time < ?', (cutoff,)).rowcount
+        if removed:
+            print(f"🗜️ Analytics: removed {removed} upload rows older than {ANALYTICS_RETENTION_DAYS} days")
+        return removed
     
     def get_stats(self):
+        """Read the statistics from the rollup tables, without touching the raw rows"""
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         
         # Total files and size
-        cursor.execute('SELECT COUNT(*), SUM(file_size), SUM(compressed_size) FROM uploads')
-        total_files, total_size, total_compressed = cursor.fetchone()
+        cursor.execute('SELECT files, total_size, total_compressed FROM upload_totals WHERE id = 1')
+        total_files, total_size, total_compressed = cursor.fetchone() or (0, 0, 0)
         
         # Today's uploads
-        today = datetime.now().date()
-        cursor.execute('SELECT COUNT(*) FROM uploads WHERE DATE(upload_time) = ?', (today,))
-        today_uploads = cursor.fetchone()[0]
+        today = datetime.now().date().isoformat()
+        cursor.execute('SELECT uploads FROM upload_days WHERE day = ?', (today,))
+        today_uploads = (cursor.fetchone() or (0,))[0]
         
         # Popular file types
-        cursor.execute('SELECT file_type, COUNT(*) FROM uploads GROUP BY file_type ORDER BY COUNT(*) DESC LIMIT 5')
+        cursor.execute('SELECT file_type, uploads FROM upload_types ORDER BY uploads DESC LIMIT 5')
         popular_types = cursor.fetchall()
         
         conn.close()
@@ -101,35 +437,492 @@ class AnalyticsDB:
             'compression_ratio': round((1 - (total_compressed or 1) / (total_size or 1)) * 100, 1) if total_size else 0
         }
 
+class AnalyticsWriter(threading.Thread):
+    """Drain the analytics queue into SQLite in batches"""
+
+    def __init__(self, db):
+        super().__init__(name='bt-analytics')
+        self.db = db
+
+    def run(self):
+        conn = sqlite3.connect(self.db.db_path)
+        conn.execute('PRAGMA synchronous=NORMAL')  # Durable across crashes of this process in WAL mode
+        next_compaction = 0
+        stopping = False
+        while not stopping:
+            try:
+                if time.monotonic() >= next_compaction:
+                    next_compaction = time.monotonic() + ANALYTICS_COMPACT_INTERVAL
+                    self.db.compact(conn)
+            except Exception as e:
+                print(f"⚠️ Analytics compaction error: {e}")
+            batch, stopping = self.next_batch(next_compaction - time.monotonic())
+            try:
+                if batch:
+                    self.db.write_events(conn, batch)
+            except Exception as e:
+                print(f"⚠️ Analytics write error: {e}")
+            if self.db.dropped:
+                print(f"⚠️ Analytics queue full, dropped {self.db.dropped} events")
+                self.db.dropped = 0
+        conn.close()
+
+    def next_batch(self, timeout):
+        """Wait up to timeout for an event, then gather more for up to the flush interval.
+
+        Returns (events, stopping); stopping is True once close() was called.
+        """
+        batch = []
+        try:
+            event = self.db.events.get(timeout=max(timeout, 0))
+        except queue.Empty:
+            return batch, False
+        deadline = time.monotonic() + ANALYTICS_FLUSH_INTERVAL
+        while event is not None:
+            batch.append(event)
+            if len(batch) >= ANALYTICS_BATCH_SIZE:
+                return batch, False
+            try:
+                event = self.db.events.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                return batch, False
+        return batch, True
+
 analytics = AnalyticsDB()
 
+FILE_TTL = 86400  # Seconds a stored file is kept (24 hours)
+MIN_FILE_TTL = 60  # Shortest lifetime a client may ask for; the longest is FILE_TTL
+
+def is_stored_file(filename):
+    """True for names in uploads/ that are user files rather than tokens or temp/system files"""
+    return (not filename.endswith('.token') and
+            not filename.startswith('.') and
+            filename not in ['.gitkeep', '.DS_Store', 'Thumbs.db'])
+
+def hash_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+# File listing pages and change feed
+#
+# GET /files with any query parameter returns one page of the catalog, sorted
+# and filtered in SQL and continued with an opaque keyset cursor, plus the
+# position in the change log the page is current as of. Every add, delete and
+# expiry is appended to that log (file_changes), so clients follow it through
+# GET /files/changes (Server-Sent Events, or a JSON long poll) instead of
+# fetching the whole listing again. Waiters are woken by writes in their own
+# process and poll the table every CHANGE_POLL_INTERVAL for other workers'.
+LIST_SORTS = {'uploaded': 'uploaded_at', 'name': 'stored_name', 'size': 'original_size', 'expires': 'expires_at'}
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+CHANGE_RETENTION = 3600  # Seconds of changes kept; clients further behind reload the listing
+CHANGE_POLL_INTERVAL = 1.0
+CHANGE_BATCH = 500  # Changes sent per response or event burst
+CHANGE_WAIT = 25  # Longest long poll, in seconds
+CHANGE_HEARTBEAT = 15  # Seconds between keep-alive comments on an idle event stream
+CHANGE_STREAM_SECONDS = 300  # An event stream then ends and the client reconnects, freeing its slot
+CHANGE_RETRY_MS = 2000  # Reconnect delay asked of EventSource clients
+
+class FileCatalog:
+    """Catalog of stored files, so listing never has to open file bodies"""
+
+    def __init__(self, db_path='analytics.db'):
+        self.db_path = db_path
+        self.changed = threading.Condition()
+        self.generation = 0  # Bumped on every change made by this process
+        self.init_db()
+
+    def init_db(self):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS files (
+                stored_name TEXT PRIMARY KEY,
+                original_size INTEGER,
+                stored_size INTEGER,
+                compressed INTEGER,
+                disk_size INTEGER,
+                mtime REAL,
+                expires_at REAL,
+                owner_hash TEXT,
+                uploaded_at REAL,
+                content_hash TEXT,
+                codec TEXT
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_uploaded ON files (uploaded_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_expires ON files (expires_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_hash ON files (content_hash)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_size ON files (original_size)')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS file_changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT,
+                stored_name TEXT,
+                size INTEGER,
+                expires_at REAL,
+                at REAL
+            )
+        ''')
+        conn.commit()
+        conn.close()
+
+    def notify(self):
+        with self.changed:
+            self.generation += 1
+            self.changed.notify_all()
+
+    def add(self, filepath, metadata, owner_token=None, owner_hash=None, uploaded_at=None, ttl=FILE_TTL):
+        """Record (or refresh) a stored file from its on-disk state and metadata.
+
+        Deduplicated entries share an inode, so the upload time is tracked here
+        rather than taken from the file's timestamps.
+        """
+        stat = os.stat(filepath)
+        if owner_token is not None:
+            owner_hash = hash_token(owner_token)
+        if uploaded_at is None:
+            uploaded_at = time.time()
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT OR REPLACE INTO files
+                (stored_name, original_size, stored_size, compressed, disk_size, mtime, expires_at, owner_hash,
+                 uploaded_at, content_hash, codec)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (os.path.basename(filepath), metadata.get('original_size', stat.st_size),
+              metadata.get('stored_size'), 1 if metadata.get('compressed') else 0,
+              stat.st_size, stat.st_mtime, uploaded_at + ttl, owner_hash,
+              uploaded_at, metadata.get('sha256'), metadata.get('codec')))
+        cursor.execute('INSERT INTO file_changes (kind, stored_name, size, expires_at, at) VALUES (?, ?, ?, ?, ?)',
+                       ('add', os.path.basename(filepath), metadata.get('original_size', stat.st_size),
+                        uploaded_at + ttl, time.time()))
+        conn.commit()
+        conn.close()
+        self.notify()
+
+    def remove(self, stored_name, reason='delete', expired_by=None):
+        """Drop a stored file's entry. Returns the removed entry as a dict, or None if there was none.
+
+        reason ('delete' or 'expire') is what the change log records. With
+        expired_by, the entry is only removed if it expires at or before that
+        time. Only one caller's DELETE finds the row, so workers racing to
+        expire the same file agree on which of them does it.
+        """
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM files WHERE stored_name = ?', (stored_name,))
+        entry = cursor.fetchone()
+        if expired_by is None:
+            cursor.execute('DELETE FROM files WHERE stored_name = ?', (stored_name,))
+        else:
+            cursor.execute('DELETE FROM files WHERE stored_name = ? AND expires_at <= ?', (stored_name, expired_by))
+        removed = cursor.rowcount > 0
+        if removed:
+            cursor.execute('INSERT INTO file_changes (kind, stored_name, size, at) VALUES (?, ?, NULL, ?)',
+                           (reason, stored_name, time.time()))
+        conn.commit()
+        conn.close()
+        if not removed:
+            return None
+        self.notify()
+        return dict(entry) if entry else {}
+
+    def get(self, stored_name):
+        """Return the catalog row for a stored file as a dict, or None"""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM files WHERE stored_name = ?', (stored_name,))
+        row = cursor.fetchone()
+        conn.close()
+        return dict(row) if row else None
+
+    def refresh(self, filepath, metadata):
+        """Re-read a rewritten file's stored form, keeping its upload time, expiry and owner.
+
+        sync only notices files whose size or mtime changed, which a rewrite may not.
+        """
+        stat = os.stat(filepath)
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE files SET original_size = ?, stored_size = ?, compressed = ?, disk_size = ?, mtime = ?,
+                content_hash = ?, codec = ?
+            WHERE stored_name = ?
+        ''', (metadata.get('original_size', stat.st_size), metadata.get('stored_size'),
+              1 if metadata.get('compressed') else 0, stat.st_size, stat.st_mtime, metadata.get('sha256'),
+              metadata.get('codec'), os.path.basename(filepath)))
+        conn.commit()
+        conn.close()
+
+    def list_files(self):
+        """Return [{'name', 'size'}] newest first"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT stored_name, original_size FROM files ORDER BY uploaded_at DESC')
+        rows = cursor.fetchall()
+        conn.close()
+        return [{'name': name, 'size': size} for name, size in rows]
+
+    def list_page(self, sort='uploaded', descending=True, after=None, limit=DEFAULT_PAGE_SIZE, extensions=(),
+                  min_size=None, max_size=None, uploaded_after=None, uploaded_before=None, owner_hashes=None):
+        """Return ([{'name', 'size', 'uploaded_at', 'expires_at'}], next_after) for one page.
+
+        after is the (sort value, name) of the last entry of the previous page;
+        next_after is None on the last page.
+        """
+        column = LIST_SORTS[sort]
+        clauses, params = [], []
+        if extensions:
+            clauses.append('(' + ' OR '.join('stored_name LIKE ?' for _ in extensions) + ')')
+            params.extend(f'%.{extension}' for extension in extensions)
+        for condition, value in [('original_size >= ?', min_size), ('original_size <= ?', max_size),
+                                 ('uploaded_at >= ?', uploaded_after), ('uploaded_at <= ?', uploaded_before)]:
+            if value is not None:
+                clauses.append(condition)
+                params.append(value)
+        if owner_hashes is not None:
+            clauses.append(f"owner_hash IN ({', '.join('?' for _ in owner_hashes)})")
+            params.extend(owner_hashes)
+        if after is not None:
+            # Keyset pagination: rows strictly past the previous page's last (value, name)
+            comparison = '<' if descending else '>'
+            clauses.append(f'({column} {comparison} ? OR ({column} = ? AND stored_name {comparison} ?))')
+            params.extend([after[0], after[0], after[1]])
+        direction = 'DESC' if descending else 'ASC'
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT stored_name, original_size, uploaded_at, expires_at, {column} FROM files {where}
+            ORDER BY {column} {direction}, stored_name {direction} LIMIT ?
+        ''', params + [limit + 1])
+        rows = cursor.fetchall()
+        conn.close()
+        files = [{'name': name, 'size': size, 'uploaded_at': uploaded_at, 'expires_at': expires_at}
+                 for name, size, uploaded_at, expires_at, _ in rows[:limit]]
+        next_after = (rows[limit - 1][4], rows[limit - 1][0]) if len(rows) > limit else None
+        return files, next_after
+
+    def latest_change(self):
+        """Sequence number of the newest change, 0 if there is none"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT MAX(seq) FROM file_changes')
+        latest = cursor.fetchone()[0]
+        conn.close()
+        return latest or 0
+
+    def changes(self, after, limit=CHANGE_BATCH):
+        """Return (changes after seq, reset); reset means some were pruned and the listing must be reloaded"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT MIN(seq), MAX(seq) FROM file_changes')
+        oldest, newest = cursor.fetchone()
+        # A cursor from before the oldest kept change, or from a catalog that has since been replaced
+        if oldest is not None and not oldest - 1 <= after <= newest:
+            conn.close()
+            return [], True
+        cursor.execute('SELECT seq, kind, stored_name, size, expires_at, at FROM file_changes '
+                       'WHERE seq > ? ORDER BY seq LIMIT ?', (after, limit))
+        rows = cursor.fetchall()
+        conn.close()
+        return [{'id': seq, 'type': kind, 'name': name, 'size': size, 'expires_at': expires_at, 'at': at}
+                for seq, kind, name, size, expires_at, at in rows], False
+
+    def wait_for_changes(self, after, timeout):
+        """Like changes(), but wait up to timeout seconds for one to arrive"""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.changed:
+                generation = self.generation
+            changes, reset = self.changes(after)
+            remaining = deadline - time.monotonic()
+            if changes or reset or remaining <= 0:
+                return changes, reset
+            with self.changed:
+                self.changed.wait_for(lambda: self.generation != generation, min(remaining, CHANGE_POLL_INTERVAL))
+
+    def prune_changes(self, before):
+        """Forget changes older than before, always keeping the newest so cursors stay checkable"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM file_changes WHERE at < ? AND seq < (SELECT MAX(seq) FROM file_changes)',
+                       (before,))
+        conn.commit()
+        conn.close()
+
+    def expiry_times(self):
+        """Return {stored_name: expires_at}"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT stored_name, expires_at FROM files')
+        rows = dict(cursor.fetchall())
+        conn.close()
+        return rows
+
+    def sync(self, upload_dir='uploads'):
+        """Bring the catalog in line with the upload directory.
+
+        Only entries whose size or mtime changed since they were recorded are
+        re-read, and then only their metadata. Returns (added, removed).
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT stored_name, disk_size, mtime, uploaded_at, expires_at, owner_hash FROM files')
+        known = {row[0]: row[1:] for row in cursor.fetchall()}
+        conn.close()
+
+        added = removed = 0
+        present = set()
+        for filename in os.listdir(upload_dir):
+            filepath = os.path.join(upload_dir, filename)
+            if not is_stored_file(filename) or not os.path.isfile(filepath):
+                continue
+            present.add(filename)
+            stat = os.stat(filepath)
+            if filename in known and known[filename][:2] == (stat.st_size, stat.st_mtime):
+                continue
+            try:
+                metadata = read_file_metadata(filepath)
+            except Exception as e:
+                print(f"Could not read metadata for {filename}: {e}")
+                metadata = {}
+            owner_hash = None
+            token_path = f"{filepath}.token"
+            if os.path.exists(token_path):
+                with open(token_path, 'r') as token_file:
+                    owner_hash = hash_token(token_file.read())
+            if filename in known:
+                # Rewritten in place (e.g. by --migrate): keep its upload time and lifetime
+                _size, _mtime, uploaded_at, expires_at, known_owner = known[filename]
+                self.add(filepath, metadata, owner_hash=owner_hash or known_owner, uploaded_at=uploaded_at,
+                         ttl=expires_at - uploaded_at)
+            else:
+                self.add(filepath, metadata, owner_hash=owner_hash, uploaded_at=stat.st_mtime)
+            added += 1
+
+        for filename in set(known) - present:
+            self.remove(filename)
+            removed += 1
+        return added, removed
+
+catalog = FileCatalog()
+
+def claim_free_path(filepath, place):
+    """Create filepath with place(path), or name_N.ext beside it if that is taken. Returns the path used.
+
+    place must fail with FileExistsError rather than replace an existing
+    file, so uploads of one name finishing at the same moment each get
+    their own.
+    """
+    name, ext = os.path.splitext(filepath)
+    candidate = filepath
+    counter = 1
+    while True:
+        try:
+            place(candidate)
+            return candidate
+        except FileExistsError:
+            candidate = f"{name}_{counter}{ext}"
+            counter += 1
+
+def move_to_free_path(temp_path, filepath):
+    """Move a finished temp file to filepath or the next free name. Returns the path used"""
+    def place(path):
+        try:
+            os.link(temp_path, path)
+        except FileExistsError:
+            raise
+        except OSError:
+            # No hard links on this filesystem: claim the name with an empty file, then move over it
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600))
+            os.replace(temp_path, path)
+    filepath = claim_free_path(filepath, place)
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    return filepath
+
+# Content-addressed blob store
+#
+# Stored files are deduplicated by the SHA-256 of their plaintext. The first
+# copy of some content is hard-linked into uploads/.blobs/<sha256>; later
+# uploads of the same content replace their own freshly written copy with
+# another link to that blob. Every named entry in uploads/ is therefore a
+# reference to the blob's inode and the link count is the reference count: a
+# blob is dropped once only its .blobs link is left. Because entries are hard
+# links, removing a blob never affects an entry that still points at it.
+BLOB_DIR = os.path.join('uploads', '.blobs')
+CONTENT_HASH_CHARS = set('0123456789abcdef')
+
+def blob_path(content_hash):
+    if not content_hash or len(content_hash) != 64 or not set(content_hash) <= CONTENT_HASH_CHARS:
+        raise ValueError("Invalid content hash")
+    return os.path.join(BLOB_DIR, content_hash)
+
+def share_blob(filepath, content_hash):
+    """Make filepath share storage with the blob for its content. Returns True if a stored copy was reused"""
+    os.makedirs(BLOB_DIR, exist_ok=True)
+    path = blob_path(content_hash)
+    try:
+        if os.path.samefile(path, filepath):
+            return True
+    except FileNotFoundError:
+        pass
+    temp_path = os.path.join(os.path.dirname(filepath), f".link-{uuid.uuid4().hex}.part")
+    try:
+        os.link(path, temp_path)
+        os.replace(temp_path, filepath)
+        return True
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(filepath, path)
+    except OSError:
+        # Another upload of the same content won the race, or the filesystem
+        # has no hard links; either way this entry simply keeps its own copy
+        pass
+    return False
+
+def link_blob(content_hash, filepath):
+    """Create a named entry for already stored content at filepath or the next free name.
+
+    Returns the path used, or None if there is no such blob.
+    """
+    try:
+        return claim_free_path(filepath, lambda path: os.link(blob_path(content_hash), path))
+    except FileNotFoundError:
+        return None
+
+def release_blob(content_hash):
+    """Drop the blob for content_hash once no named entry links to it"""
+    try:
+        path = blob_path(content_hash)
+        if os.stat(path).st_nlink <= 1:
+            os.remove(path)
+            print(f"🗑️ Blob released: {content_hash[:12]}")
+    except (ValueError, FileNotFoundError):
+        pass
+
+def collect_orphan_blobs():
+    """Drop every blob that no named entry links to any more"""
+    if os.path.isdir(BLOB_DIR):
+        for content_hash in os.listdir(BLOB_DIR):
+            release_blob(content_hash)
+
 # A simple token generator for user session management
 def generate_token():
     return secrets.token_urlsafe(16)
 
-# Smart file compression
-def compress_file_data(data, filename):
-    """Compress file data if beneficial"""
-    # Don't compress already compressed formats
-    compressed_formats = {'.jpg', '.jpeg', '.png', '.gif', '.mp4', '.mp3', '.zip', '.rar', '.7z'}
-    ext = os.path.splitext(filename)[1].lower()
-    
-    if ext in compressed_formats:
-        return data, len(data)  # Return original data and size
-    
-    # Compress for text files, documents, etc.
-    compressed = gzip.compress(data)
-    if len(compressed) < len(data) * 0.95:  # Only if compression saves >5%
-        return compressed, len(compressed)
-    else:
-        return data, len(data)
+# Legacy files skipped gzip for these extensions
+COMPRESSED_FORMATS = {'.jpg', '.jpeg', '.png', '.gif', '.mp4', '.mp3', '.zip', '.rar', '.7z'}
 
 def decompress_file_data(data, filename):
     """Decompress file data if it was compressed"""
-    compressed_formats = {'.jpg', '.jpeg', '.png', '.gif', '.mp4', '.mp3', '.zip', '.rar', '.7z'}
     ext = os.path.splitext(filename)[1].lower()
     
-    if ext in compressed_formats:
+    if ext in COMPRESSED_FORMATS:
         return data  # Not compressed
     
     try:
@@ -137,40 +930,1838 @@ def decompress_file_data(data, filename):
     except:
         return data  # Fallback to original if decompression fails
 
-def add_file_expiry(filepath, hours=24):
-    expiry_time = datetime.now() + timedelta(hours=hours)
-    os.utime(filepath, (expiry_time.timestamp(), expiry_time.timestamp()))
+# Adaptive compression
+#
+# Each stored file is compressed with one codec chosen from a sample of its
+# first segment: already-compressed containers are recognised by their magic
+# bytes and stored as is, anything else gets a fast trial compression whose
+# ratio picks the codec and level. Deflate segments are written as gzip
+# members, so a run of them is itself a valid gzip stream.
+CODEC_STORE = 'store'
+CODEC_DEFLATE = 'deflate'
+CODEC_LZMA = 'lzma'
+CODEC_IDS = {CODEC_STORE: 1, CODEC_DEFLATE: 2, CODEC_LZMA: 3}  # Stored in the segment header
+CODEC_NAMES = {codec_id: name for name, codec_id in CODEC_IDS.items()}
+CODEC_SAMPLE_SLICE = 16 * 1024  # Three slices of the first segment are trial-compressed
+COMPRESSION_POLICIES = ('auto', 'fast', 'max', 'off')
+compression_policy = 'auto'
+
+# (offset, magic) of formats whose payload is already compressed
+COMPRESSED_SIGNATURES = [
+    (0, b'\xff\xd8\xff'),              # JPEG
+    (0, b'\x89PNG\r\n\x1a\n'),         # PNG
+    (0, b'GIF8'),                      # GIF
+    (0, b'PK\x03\x04'),                # ZIP, DOCX/XLSX/PPTX, ODF, JAR, APK, EPUB
+    (0, b'\x1f\x8b'),                  # gzip
+    (0, b'BZh'),                       # bzip2
+    (0, b'\xfd7zXZ\x00'),              # xz
+    (0, b'\x28\xb5\x2f\xfd'),          # zstd
+    (0, b"7z\xbc\xaf'\x1c"),           # 7-Zip
+    (0, b'Rar!\x1a\x07'),              # RAR
+    (0, b'\x1a\x45\xdf\xa3'),          # Matroska / WebM
+    (0, b'OggS'),                      # Ogg
+    (0, b'fLaC'),                      # FLAC
+    (0, b'ID3'),                       # MP3 with ID3 tag
+    (0, b'\xff\xfb'),                  # MP3 frame
+    (0, b'wOF2'),                      # WOFF2
+    (4, b'ftyp'),                      # MP4, MOV, HEIC, AVIF, M4A
+    (8, b'WEBP'),                      # WebP (RIFF container)
+]
+
+def set_compression_policy(policy):
+    """'auto' adapts to the data, 'fast' never spends more than deflate level 1,
+    'max' allows lzma for very compressible data, 'off' stores everything"""
+    global compression_policy
+    if policy not in COMPRESSION_POLICIES:
+        raise ValueError(f"Unknown compression policy: {policy}")
+    compression_policy = policy
+
+def sniff_compressed(data):
+    """True if data starts like a format that is already compressed"""
+    return any(data[offset:offset + len(magic)] == magic for offset, magic in COMPRESSED_SIGNATURES)
+
+def codec_sample(data):
+    """Return slices from the start, middle and end of the first segment"""
+    if len(data) <= 3 * CODEC_SAMPLE_SLICE:
+        return data
+    middle = (len(data) - CODEC_SAMPLE_SLICE) // 2
+    return (data[:CODEC_SAMPLE_SLICE] + data[middle:middle + CODEC_SAMPLE_SLICE] +
+            data[-CODEC_SAMPLE_SLICE:])
+
+def choose_codec(data, policy=None):
+    """Pick (codec, level) for a file from the plaintext of its first segment"""
+    policy = policy or compression_policy
+    if policy == 'off' or not data or sniff_compressed(data):
+        return CODEC_STORE, 0
+    sample = codec_sample(data)
+    ratio = len(zlib.compress(sample, 1)) / len(sample)
+    if ratio > 0.9:
+        return CODEC_STORE, 0
+    if policy == 'fast' or ratio > 0.6:
+        return CODEC_DEFLATE, 1
+    if policy == 'max' and ratio < 0.35:
+        return CODEC_LZMA, 6
+    return CODEC_DEFLATE, 6
+
+def compress_segment(data, codec, level):
+    if codec == CODEC_DEFLATE:
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    if codec == CODEC_LZMA:
+        return lzma.compress(data, preset=level)
+    return data
+
+def decompress_segment(data, codec):
+    if codec == CODEC_DEFLATE:
+        return gzip.decompress(data)
+    if codec == CODEC_LZMA:
+        return lzma.decompress(data)
+    return data
+
+# Segmented storage format (BTS2)
+#
+# Every stored file is split into fixed-size plaintext segments that are
+# compressed and encrypted independently, so any byte range can be decoded by
+# touching only the segments that cover it:
+#
+#   header | segment 0 | segment 1 | ... | encrypted index | 4-byte index len | b'BTSI'
+#
+# The header is stored in the clear and bound to every segment as associated
+# data. Each segment is AES-GCM encrypted under a per-file key derived from KEY
+# and the header's random file id, using the segment number as nonce and the
+# segment number plus a "last segment" flag as associated data, so segments
+# cannot be reordered, swapped between files or truncated away unnoticed. The
+# index holds the metadata JSON followed by the stored length of each segment.
+# The codec field holds the codec id in its high byte and the level in its low
+# byte, and the header ends with the id of the key the file was sealed with.
+SEGMENT_MAGIC = b'BTS2'
+SEGMENT_INDEX_MAGIC = b'BTSI'
+SEGMENT_HEADER = struct.Struct('>4sBBHI16s')  # magic, version, flags, codec, segment size, file id
+SEGMENT_VERSION = 3
+SEGMENT_KEY_ID_SIZE = 8  # Raw bytes of the key id follow the header
+SEGMENT_SIZE = 256 * 1024  # Plaintext bytes per segment
+SEGMENT_FLAG_COMPRESSED = 0x01
+SEGMENT_INDEX_NONCE = 0xFFFFFFFF  # Segment numbers never reach this value
+STREAM_READ_SIZE = 64 * 1024  # Bytes read from disk or socket per step
+
+def derive_file_key(file_id, key=None):
+    """Derive the raw AES-GCM key for one stored file (from the primary key by default)"""
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=file_id, info=b'b-transfer segment key')
+    return hkdf.derive(base64.urlsafe_b64decode(key or KEY))
+
+def segment_nonce(index):
+    return index.to_bytes(12, 'big')
+
+def segment_aad(header, index, is_last):
+    return header + struct.pack('>IB', index, 1 if is_last else 0)
+
+# Codec pool
+#
+# Sealing and opening segments (compression + AES-GCM) is CPU bound. When a pool is
+# configured, segments are handed to it with a bounded number in flight per
+# transfer, so one large file uses several cores and concurrent transfers share
+# them. zlib, lzma and cryptography's AES-GCM all release the GIL, so a thread pool
+# scales without the pickling cost of a process pool; 'process' is there for
+# interpreters where that does not hold. Without a pool every job runs inline.
+CODEC_WINDOW = 8  # Segments in flight per transfer (8 x 256 KiB)
+codec_pool = None
+
+def configure_codec_pool(kind, workers):
+    """Start the shared codec pool: 'process', 'thread' or 'off'"""
+    global codec_pool
+    if kind == 'process':
+        codec_pool = ProcessPoolExecutor(max_workers=workers)
+        # Start the workers now, before the server starts its own threads
+        codec_pool.submit(int).result()
+    elif kind == 'thread':
+        codec_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bt-codec')
+    else:
+        codec_pool = None
+
+def submit_codec_job(fn, *args):
+    """Run fn(*args) on the codec pool, or inline if there is none. Returns a Future"""
+    if codec_pool is not None:
+        return codec_pool.submit(fn, *args)
+    future = Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+def map_codec_jobs(fn, jobs, window=CODEC_WINDOW):
+    """Yield fn(*args) for each args tuple in jobs, in order, with up to window running at once"""
+    if codec_pool is None:
+        for args in jobs:
+            yield fn(*args)
+        return
+    in_flight = collections.deque()
+    for args in jobs:
+        in_flight.append(codec_pool.submit(fn, *args))
+        if len(in_flight) >= window:
+            yield in_flight.popleft().result()
+    while in_flight:
+        yield in_flight.popleft().result()
+
+def new_segment_header(codec, level, segment_size=SEGMENT_SIZE, file_id=None, key_id=None):
+    """Return a header for a new file, with a random file id unless one is given.
+
+    The file is tagged with the primary key unless another key id is given.
+    """
+    flags = SEGMENT_FLAG_COMPRESSED if codec != CODEC_STORE else 0
+    return SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, flags, CODEC_IDS[codec] << 8 | level,
+                               segment_size, file_id or os.urandom(16)) + bytes.fromhex(key_id or KEY_ID)
+
+def read_segment_header(f):
+    """Read the header at the start of a segmented file"""
+    return f.read(SEGMENT_HEADER.size + SEGMENT_KEY_ID_SIZE)
+
+def parse_segment_header(header):
+    """Return (codec, level, segment_size, file_id, key_id) of a segment header"""
+    if len(header) != SEGMENT_HEADER.size + SEGMENT_KEY_ID_SIZE:
+        raise ValueError("Truncated segment header")
+    magic, version, _flags, codec_field, segment_size, file_id = SEGMENT_HEADER.unpack(header[:SEGMENT_HEADER.size])
+    if magic != SEGMENT_MAGIC:
+        raise ValueError("Not a segmented file")
+    if version != SEGMENT_VERSION:
+        raise ValueError(f"Unsupported segment format version {version}")
+    codec, level = CODEC_NAMES.get(codec_field >> 8), codec_field & 0xFF
+    if codec is None:
+        raise ValueError("Unknown segment codec")
+    return codec, level, segment_size, file_id, header[SEGMENT_HEADER.size:].hex()
+
+def seal_segment(aead, header, index, data, codec, level, is_last):
+    """Compress and encrypt the plaintext of one segment"""
+    started = time.perf_counter()
+    data = compress_segment(data, codec, level)
+    compressed = time.perf_counter()
+    sealed = aead.encrypt(segment_nonce(index), data, segment_aad(header, index, is_last))
+    metrics.observe('bt_upload_stage_seconds', compressed - started, ('compress',))
+    metrics.observe('bt_upload_stage_seconds', time.perf_counter() - compressed, ('encrypt',))
+    return sealed
+
+def seal_segment_job(file_key, header, index, data, codec, level, is_last):
+    """Codec pool job: seal one segment (takes the raw key so it can run in another process)"""
+    return seal_segment(AESGCM(file_key), header, index, data, codec, level, is_last)
+
+def decrypt_segment_job(file_key, header, index, sealed, is_last, direction='download'):
+    """Codec pool job: authenticate and decrypt one segment, leaving it compressed
+
+    direction names the stage histogram the time goes to; finalize opens
+    segments again to check an upload.
+    """
+    started = time.perf_counter()
+    data = AESGCM(file_key).decrypt(segment_nonce(index), sealed, segment_aad(header, index, is_last))
+    metrics.observe(f'bt_{direction}_stage_seconds', time.perf_counter() - started, ('decrypt',))
+    return data
+
+def open_segment_job(file_key, header, index, sealed, codec, is_last, direction='download'):
+    """Codec pool job: authenticate, decrypt and decompress one segment"""
+    data = decrypt_segment_job(file_key, header, index, sealed, is_last, direction)
+    started = time.perf_counter()
+    data = decompress_segment(data, codec)
+    metrics.observe(f'bt_{direction}_stage_seconds', time.perf_counter() - started, ('decompress',))
+    return data
+
+def seal_segment_index(aead, header, metadata, segment_lengths):
+    """Return the encrypted index followed by the trailer that locates it"""
+    metadata_json = json.dumps(metadata).encode()
+    index = (len(metadata_json).to_bytes(4, 'big') + metadata_json +
+             struct.pack(f'>{len(segment_lengths)}I', *segment_lengths))
+    sealed = aead.encrypt(segment_nonce(SEGMENT_INDEX_NONCE), index, header + b'index')
+    return sealed + len(sealed).to_bytes(4, 'big') + SEGMENT_INDEX_MAGIC
+
+def segment_metadata(filename, codec, level, original_size, segment_lengths, content_hash=None):
+    metadata = {
+        'compressed': codec != CODEC_STORE,
+        'codec': codec,
+        'level': level,
+        'original_size': original_size,
+        # AES-GCM adds a 16-byte tag to every segment
+        'stored_size': sum(segment_lengths) - 16 * len(segment_lengths),
+        'filename': filename
+    }
+    if content_hash:
+        metadata['sha256'] = content_hash
+    return metadata
+
+class SegmentedWriter:
+    """Compress, encrypt and write an upload as a segmented file as it arrives"""
+
+    def __init__(self, filepath, filename, codec=None, segment_size=SEGMENT_SIZE):
+        """codec is a (codec, level) pair; by default it is chosen from the first segment"""
+        self.filepath = filepath
+        self.filename = filename
+        self.segment_size = segment_size
+        self.file_id = os.urandom(16)
+        self.file_key = derive_file_key(self.file_id)
+        self.aead = AESGCM(self.file_key)
+        self.codec = self.level = self.header = None
+        self.temp_path = os.path.join(os.path.dirname(filepath), f".upload-{uuid.uuid4().hex}.part")
+        self.pending = bytearray()
+        self.in_flight = collections.deque()  # Segments being sealed on the codec pool, in order
+        self.segment_count = 0
+        self.segment_lengths = []
+        self.original_size = 0
+        self.content_hash = hashlib.sha256()
+        self.file = open(self.temp_path, 'wb')
+        if codec is not None:
+            self._start(*codec)
+
+    def _start(self, codec, level):
+        """Fix the codec and write the header, which every segment is bound to"""
+        self.codec, self.level = codec, level
+        self.header = new_segment_header(codec, level, self.segment_size, self.file_id)
+        self.file.write(self.header)
+
+    def write(self, data):
+        self.original_size += len(data)
+        self.content_hash.update(data)
+        self.pending += data
+        # Keep at least one byte back so the final segment is always written by close()
+        while len(self.pending) > self.segment_size:
+            self._write_segment(bytes(self.pending[:self.segment_size]), is_last=False)
+            del self.pending[:self.segment_size]
+
+    def _write_segment(self, data, is_last):
+        if self.header is None:
+            self._start(*choose_codec(data))
+        self.in_flight.append(submit_codec_job(seal_segment_job, self.file_key, self.header, self.segment_count,
+                                               data, self.codec, self.level, is_last))
+        self.segment_count += 1
+        # Bound the memory held by segments waiting for the pool
+        self._flush_segments(CODEC_WINDOW - 1)
+
+    def _flush_segments(self, keep):
+        while len(self.in_flight) > keep:
+            sealed = self.in_flight.popleft().result()
+            self.segment_lengths.append(len(sealed))
+            started = time.perf_counter()
+            self.file.write(sealed)
+            metrics.observe('bt_upload_stage_seconds', time.perf_counter() - started, ('write',))
+
+    def close(self, claim=False):
+        """Write the last segment and the index, then move the file into place.
+
+        With claim, an existing file is never replaced: the file takes the next
+        free name instead, and self.filepath is updated to it.
+        """
+        self._write_segment(bytes(self.pending), is_last=True)
+        self.pending = bytearray()
+        self._flush_segments(0)
+
+        metadata = segment_metadata(self.filename, self.codec, self.level, self.original_size,
+                                    self.segment_lengths, self.content_hash.hexdigest())
+        self.file.write(seal_segment_index(self.aead, self.header, metadata, self.segment_lengths))
+        self.file.close()
+        if claim:
+            self.filepath = move_to_free_path(self.temp_path, self.filepath)
+        else:
+            os.replace(self.temp_path, self.filepath)
+        return metadata
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+class SegmentedReader:
+    """Random access to the plaintext of a segmented file"""
+
+    def __init__(self, filepath):
+        self.file = open(filepath, 'rb')
+        try:
+            self.header = read_segment_header(self.file)
+            self.codec, self.level, self.segment_size, self.file_id, self.key_id = parse_segment_header(self.header)
+            self.compressed = self.codec != CODEC_STORE
+
+            self.file.seek(-8, os.SEEK_END)
+            trailer = self.file.read(8)
+            if trailer[4:] != SEGMENT_INDEX_MAGIC:
+                raise ValueError("Segment index missing")
+            index_len = int.from_bytes(trailer[:4], 'big')
+            self.file.seek(-8 - index_len, os.SEEK_END)
+            sealed_index = self.file.read(index_len)
+            index = self._open_index(self.file_id, sealed_index)
+        except Exception:
+            self.file.close()
+            raise
+
+        metadata_len = int.from_bytes(index[:4], 'big')
+        self.metadata = json.loads(index[4:4+metadata_len].decode())
+        self.original_size = self.metadata['original_size']
+        lengths = index[4+metadata_len:]
+        self.segment_lengths = struct.unpack(f'>{len(lengths) // 4}I', lengths)
+        self.segment_offsets = []
+        offset = len(self.header)
+        for length in self.segment_lengths:
+            self.segment_offsets.append(offset)
+            offset += length
+
+    def _open_index(self, file_id, sealed_index):
+        """Derive the file's key from the key its header names and decrypt the index with it"""
+        if self.key_id not in KEYRING:
+            raise ValueError(f"File was encrypted with unknown key {self.key_id}")
+        self.file_key = derive_file_key(file_id, KEYRING[self.key_id])
+        self.aead = AESGCM(self.file_key)
+        return self.aead.decrypt(segment_nonce(SEGMENT_INDEX_NONCE), sealed_index, self.header + b'index')
+
+    @property
+    def segment_count(self):
+        return len(self.segment_lengths)
+
+    def read_sealed_segment(self, index):
+        """Return the encrypted bytes of one segment"""
+        started = time.perf_counter()
+        self.file.seek(self.segment_offsets[index])
+        sealed = self.file.read(self.segment_lengths[index])
+        metrics.observe('bt_download_stage_seconds', time.perf_counter() - started, ('read',))
+        return sealed
+
+    def open_segment(self, index, sealed):
+        """Authenticate and decrypt one segment, returning its stored (possibly compressed) bytes"""
+        is_last = index == self.segment_count - 1
+        return self.aead.decrypt(segment_nonce(index), sealed, segment_aad(self.header, index, is_last))
+
+    def read_segment(self, index):
+        """Return the plaintext of one segment"""
+        data = self.open_segment(index, self.read_sealed_segment(index))
+        return decompress_segment(data, self.codec)
+
+    def iter_range(self, start, end):
+        """Yield the plaintext bytes in [start, end), decoding only the covering segments.
+
+        Segments are read ahead and decoded on the codec pool while earlier
+        ones are being sent.
+        """
+        if start >= end:
+            return
+        first = start // self.segment_size
+        last = (end - 1) // self.segment_size
+        for index, data in enumerate(self.iter_segments(first, last), first):
+            base = index * self.segment_size
+            yield data[max(start - base, 0):end - base]
+
+    def iter_stored(self):
+        """Yield every segment decrypted but still compressed.
+
+        For deflate files this is a valid gzip stream of the whole file,
+        metadata['stored_size'] bytes long.
+        """
+        yield from self.iter_segments(0, self.segment_count - 1, decompress=False)
+
+    def iter_segments(self, first, last, decompress=True):
+        """Yield segments first..last decoded, or only decrypted, taking hot ones from the segment cache"""
+        window = CODEC_WINDOW if codec_pool is not None else 1
+        pending = collections.deque()
+        for index in range(first, last + 1):
+            is_last = index == self.segment_count - 1
+            if decompress:
+                key = (self.file_id, 'plain', index)
+                load = lambda index=index, is_last=is_last: submit_codec_job(
+                    open_segment_job, self.file_key, self.header, index, self.read_sealed_segment(index),
+                    self.codec, is_last)
+            else:
+                key = (self.file_id, 'stored', index)
+                load = lambda index=index, is_last=is_last: submit_codec_job(
+                    decrypt_segment_job, self.file_key, self.header, index, self.read_sealed_segment(index), is_last)
+            pending.append(segment_cache.fetch(key, load))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Segment cache
+#
+# Decoded segments are kept in a byte-budgeted LRU shared by all handler
+# threads, so a file many people fetch at once is read and decrypted once.
+# Entries are keyed by the file's random id, which every hard link to the same
+# blob shares, and by whether they hold plaintext or still-compressed bytes
+# (the form gzip responses send). A miss that another thread is already
+# loading waits for that load instead of starting its own. Entries of a file
+# are dropped when it is deleted or expires. The cache holds plaintext in
+# memory; set $BT_SEGMENT_CACHE_MB=0 to turn it off.
+class SegmentCache:
+    """LRU of decoded segments with single-flight loading and hit/miss/eviction counters"""
+
+    def __init__(self, budget=0):
+        self.budget = budget
+        self.size = 0
+        self.entries = collections.OrderedDict()  # key -> bytes, least recently used first
+        self.loading = {}  # key -> Future of a load in progress
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.coalesced = self.evictions = 0
+
+    def resize(self, budget):
+        with self.lock:
+            self.budget = budget
+            self._evict()
+
+    def fetch(self, key, load):
+        """Return a Future of the segment for key. load() returns a Future of it and runs only on a miss"""
+        if not self.budget:
+            return load()
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                future = Future()
+                future.set_result(data)
+                return future
+            future = self.loading.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future
+            future = self.loading[key] = Future()
+            self.misses += 1
+        try:
+            loaded = load()
+        except Exception as e:
+            with self.lock:
+                del self.loading[key]
+            future.set_exception(e)
+            return future
+        loaded.add_done_callback(lambda done: self._loaded(key, future, done))
+        return future
+
+    def _loaded(self, key, future, done):
+        error = done.exception()
+        with self.lock:
+            del self.loading[key]
+            if error is None and len(done.result()) <= self.budget:
+                self.entries[key] = done.result()
+                self.size += len(done.result())
+                self._evict()
+        if error is None:
+            future.set_result(done.result())
+        else:
+            future.set_exception(error)
+
+    def _evict(self):
+        while self.size > self.budget:
+            _, data = self.entries.popitem(last=False)
+            self.size -= len(data)
+            self.evictions += 1
+
+    def invalidate(self, file_id):
+        """Drop every cached segment of a file"""
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == file_id]:
+                self.size -= len(self.entries.pop(key))
+
+    def stats(self):
+        with self.lock:
+            return {'budget_bytes': self.budget, 'bytes': self.size, 'entries': len(self.entries),
+                    'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced,
+                    'evictions': self.evictions}
+
+segment_cache = SegmentCache(int(float(os.environ.get('BT_SEGMENT_CACHE_MB', 256)) * 1024 * 1024))
+metrics.register('counter', 'bt_segment_cache_requests_total',
+                 'Segment cache lookups: hits, misses, and misses that joined a load in progress', ('result',),
+                 collect=lambda: [(('hit',), segment_cache.hits), (('miss',), segment_cache.misses),
+                                  (('coalesced',), segment_cache.coalesced)])
+metrics.register('counter', 'bt_segment_cache_evictions_total', 'Segments evicted from the segment cache',
+                 collect=lambda: [((), segment_cache.evictions)])
+metrics.register('gauge', 'bt_segment_cache_bytes', 'Bytes held by the segment cache',
+                 collect=lambda: [((), segment_cache.size)])
+
+def segment_file_id(filepath):
+    """The file id in a segmented file's header, or None for other files"""
+    try:
+        with open(filepath, 'rb') as f:
+            return parse_segment_header(read_segment_header(f))[3]
+    except (OSError, ValueError, struct.error):
+        return None
+
+def iter_segmented_file(filepath, start=0, end=None):
+    """Yield a byte range of a segmented file, closing it when done"""
+    with SegmentedReader(filepath) as reader:
+        yield from reader.iter_range(start, reader.original_size if end is None else end)
+
+def read_legacy_file(filepath, filename):
+    """Decrypt a whole-file Fernet token written before the segmented format"""
+    with open(filepath, 'rb') as f:
+        decrypted_data = fernet.decrypt(f.read())
+
+    # Check if this is new format with metadata
+    try:
+        # Extract metadata length (first 4 bytes)
+        metadata_len = int.from_bytes(decrypted_data[:4], 'big')
+        # Extract metadata JSON
+        metadata_json = decrypted_data[4:4+metadata_len]
+        metadata = json.loads(metadata_json.decode())
+        # Extract file data
+        file_data = decrypted_data[4+metadata_len:]
+
+        # Decompress only if it was compressed
+        if metadata.get('compressed', False):
+            return gzip.decompress(file_data)
+        return file_data
+
+    except (json.JSONDecodeError, ValueError, struct.error):
+        # Fallback to old format
+        return decompress_file_data(decrypted_data, filename)
+
+def stored_format(filepath):
+    """Return 'segmented' or 'legacy' for a stored file"""
+    with open(filepath, 'rb') as f:
+        magic = f.read(4)
+    return 'segmented' if magic == SEGMENT_MAGIC else 'legacy'
+
+def open_stored_ranges(filepath, filename):
+    """Return (original_size, read_range) for any stored file format.
+
+    read_range(start, end) yields the plaintext bytes in [start, end). For
+    segmented files only the segments covering the range are decoded; legacy
+    files are decrypted whole.
+    """
+    file_format = stored_format(filepath)
+    if file_format == 'segmented':
+        with SegmentedReader(filepath) as reader:
+            original_size = reader.original_size
+        return original_size, lambda start, end: iter_segmented_file(filepath, start, end)
+
+    final_data = read_legacy_file(filepath, filename)
+
+    def read_range(start, end):
+        for i in range(start, end, STREAM_READ_SIZE):
+            yield final_data[i:min(i + STREAM_READ_SIZE, end)]
+    return len(final_data), read_range
+
+def open_gzip_stream(filepath):
+    """Return (length, chunk iterator) of a stored file as gzip, or None if it is not stored that way"""
+    if stored_format(filepath) != 'segmented':
+        return None
+    with SegmentedReader(filepath) as reader:
+        if reader.codec != CODEC_DEFLATE:
+            return None
+        length = reader.metadata['stored_size']
+
+    def read_stored():
+        with SegmentedReader(filepath) as reader:
+            yield from reader.iter_stored()
+    return length, read_stored()
+
+def is_deflate_stored(entry):
+    """True if a catalogued file is stored with the deflate codec, and so has a gzip form"""
+    return entry['codec'] == CODEC_DEFLATE
+
+def accepts_gzip(accept_encoding):
+    """True if an Accept-Encoding header allows a gzip response"""
+    qualities = {}
+    for item in (accept_encoding or '').split(','):
+        coding, _, params = item.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name.lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.strip().lower()] = quality
+    return qualities.get('gzip', qualities.get('x-gzip', qualities.get('*', 0.0))) > 0
+
+def etag_matches(if_none_match, etag):
+    """True if an If-None-Match header names etag (weak comparison, as RFC 9110 asks for it)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    tags = (tag.strip() for tag in if_none_match.split(','))
+    return etag.removeprefix('W/') in (tag.removeprefix('W/') for tag in tags)
+
+def parse_http_date(value):
+    """Seconds since the epoch of an HTTP date, or None if it is not one"""
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date.timestamp()
+
+def is_not_modified(headers, etag, last_modified):
+    """True if the client's copy is current, by If-None-Match or else If-Modified-Since"""
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match:
+        return etag_matches(if_none_match, etag) if etag else if_none_match.strip() == '*'
+    since = parse_http_date(headers.get('If-Modified-Since')) if headers.get('If-Modified-Since') else None
+    return since is not None and last_modified is not None and int(last_modified) <= since
+
+def if_range_allows(if_range, etag, last_modified):
+    """True if a range request may get its range, given its If-Range header.
+
+    The entity tag has to match strongly, or the date has to be the exact
+    Last-Modified second; otherwise the client's partial copy is stale and
+    gets the whole file.
+    """
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith(('"', 'W/')):
+        return etag is not None and if_range == etag
+    date = parse_http_date(if_range)
+    return date is not None and last_modified is not None and int(last_modified) == date
+
+def open_stored_file(filepath, filename):
+    """Return (original_size, chunk iterator) for any stored file format"""
+    original_size, read_range = open_stored_ranges(filepath, filename)
+    return original_size, read_range(0, original_size)
+
+MAX_RANGES = 16  # More ranges than this in one request are served as a full response
+
+def parse_range_header(range_header, size):
+    """Parse a 'Range: bytes=...' header into a list of half-open (start, end) ranges.
+
+    Returns None when the header should be ignored (absent, malformed or not
+    byte ranges) and an empty list when no range is satisfiable.
+    """
+    if not range_header:
+        return None
+    unit, _, spec = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec:
+        return None
+
+    ranges = []
+    for part in spec.split(','):
+        first, sep, last = part.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if first == '':
+                # Suffix range: the last N bytes
+                suffix = int(last)
+                if suffix <= 0:
+                    continue
+                start, end = max(size - suffix, 0), size
+            else:
+                start = int(first)
+                end = int(last) + 1 if last else size
+                if start < 0 or (last and end <= start):
+                    return None
+                end = min(end, size)
+        except ValueError:
+            return None
+        if start < size:
+            ranges.append((start, end))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+def read_file_metadata(filepath):
+    """Return the stored metadata dict of a file without decoding its body when possible"""
+    file_format = stored_format(filepath)
+    if file_format == 'segmented':
+        with SegmentedReader(filepath) as reader:
+            return reader.metadata
+    with open(filepath, 'rb') as f:
+        decrypted_data = fernet.decrypt(f.read())
+    metadata_len = int.from_bytes(decrypted_data[:4], 'big')
+    return json.loads(decrypted_data[4:4+metadata_len].decode())
+
+def migrate_file(filepath):
+    """Rewrite a legacy file, or one sealed under an older key, in the segmented format keeping its timestamps.
+
+    Returns the new metadata.
+    """
+    filename = os.path.basename(filepath)
+    stat = os.stat(filepath)
+    _original_size, chunks = open_stored_file(filepath, filename)
+    writer = SegmentedWriter(filepath, filename)
+    try:
+        for chunk in chunks:
+            writer.write(chunk)
+        metadata = writer.close()
+    except Exception:
+        writer.abort()
+        raise
+    os.utime(filepath, (stat.st_atime, stat.st_mtime))
+    return metadata
+
+def segment_key_id(filepath):
+    """Return the id of the key a segmented file names in its header, or None"""
+    with open(filepath, 'rb') as f:
+        return parse_segment_header(read_segment_header(f))[4]
+
+def is_current_file(filepath):
+    """True if filepath is a segmented file sealed under the primary key"""
+    try:
+        return stored_format(filepath) == 'segmented' and segment_key_id(filepath) == KEY_ID
+    except (OSError, ValueError):
+        return False
+
+def migrate_uploads(upload_dir='uploads'):
+    """Convert every stored file that is not yet segmented under the primary key.
+
+    Files sealed under an older key are re-encrypted, so retired keys can be
+    dropped from the keyring afterwards. Deduplicated entries are re-encrypted
+    once and then share the new copy, which also replaces their blob.
+    Returns (migrated, failed)
+    """
+    migrated = failed = 0
+    for filename in sorted(os.listdir(upload_dir)):
+        filepath = os.path.join(upload_dir, filename)
+        if not is_stored_file(filename) or not os.path.isfile(filepath) or is_current_file(filepath):
+            continue
+        try:
+            content_hash = None
+            if stored_format(filepath) == 'segmented':
+                content_hash = read_file_metadata(filepath).get('sha256')
+            if content_hash and is_current_file(blob_path(content_hash)):
+                # Another entry for the same content was migrated already
+                share_blob(filepath, content_hash)
+            else:
+                content_hash = migrate_file(filepath).get('sha256')
+                if content_hash:
+                    if not is_current_file(blob_path(content_hash)):
+                        # The blob is still sealed under the old key; the migrated copy takes its place
+                        try:
+                            os.remove(blob_path(content_hash))
+                        except FileNotFoundError:
+                            pass
+                    share_blob(filepath, content_hash)
+            catalog.refresh(filepath, read_file_metadata(filepath))
+            migrated += 1
+            print(f"🔁 Migrated: {filename}")
+        except Exception as e:
+            failed += 1
+            print(f"⚠️ Could not migrate {filename}: {e}")
+    # Blobs whose entries were all rewritten are left with no other link
+    collect_orphan_blobs()
+    return migrated, failed
+
+MAX_UPLOAD_SIZE = 5 * 1024 ** 3  # 5GB per request
+MAX_PART_HEADER_SIZE = 16 * 1024
+MAX_FIELD_SIZE = 64 * 1024  # Non-file form fields are kept in memory
+
+class UploadError(ValueError):
+    """An upload the server cannot accept (answered with 400)"""
+
+class MultipartError(UploadError):
+    """Malformed multipart/form-data body"""
+
+class UploadTooLarge(MultipartError):
+    """Upload exceeds MAX_UPLOAD_SIZE"""
+
+class MultipartPart:
+    """One part of a multipart body; read() streams its bytes straight from the socket"""
+
+    def __init__(self, parser, headers):
+        self.parser = parser
+        self.headers = headers
+        self.name = headers.get_param('name', header='content-disposition')
+        self.filename = headers.get_filename()
+        self.content_type = headers.get_content_type()
+        self.done = False
+
+    def read(self, size=STREAM_READ_SIZE):
+        """Return up to size bytes of the part body, or b'' once it is exhausted"""
+        if self.done:
+            return b''
+        data, self.done = self.parser._read_body(size)
+        return data
+
+    def drain(self):
+        while self.read():
+            pass
+
+class MultipartParser:
+    """Incremental multipart/form-data parser.
+
+    Reads the request body from rfile in STREAM_READ_SIZE steps and never holds
+    more than one step plus a boundary's worth of data, so file parts can be
+    handed to the storage pipeline as they arrive. Iterate to get the parts in
+    order; each part must be read to the end (or drained) before the next one.
+    """
+
+    def __init__(self, rfile, boundary, content_length, max_size=MAX_UPLOAD_SIZE):
+        if content_length > max_size:
+            raise UploadTooLarge(f"Upload exceeds {max_size} bytes")
+        self.rfile = rfile
+        self.remaining = content_length
+        self.delimiter = b'\r\n--' + boundary.encode('latin-1')
+        self.buffer = bytearray()
+        self.finished = False
+        self.current = None
+
+    def _fill(self):
+        """Read the next piece of the body into the buffer. Returns False at end of body"""
+        if self.remaining <= 0:
+            return False
+        data = self.rfile.read(min(self.remaining, STREAM_READ_SIZE))
+        if not data:
+            raise MultipartError("Connection closed before the upload finished")
+        self.remaining -= len(data)
+        self.buffer += data
+        return True
+
+    def _read_until(self, marker, limit):
+        """Consume and return the buffer up to marker, reading more as needed"""
+        while True:
+            index = self.buffer.find(marker)
+            if index >= 0:
+                data = bytes(self.buffer[:index])
+                del self.buffer[:index + len(marker)]
+                return data
+            if len(self.buffer) > limit or not self._fill():
+                raise MultipartError("Malformed multipart body")
+
+    def _read_body(self, size):
+        """Return (data, part_finished) for the part being read"""
+        while True:
+            index = self.buffer.find(self.delimiter)
+            if index >= 0:
+                if index > size:
+                    data = bytes(self.buffer[:size])
+                    del self.buffer[:size]
+                    return data, False
+                data = bytes(self.buffer[:index])
+                del self.buffer[:index + len(self.delimiter)]
+                self._finish_part()
+                return data, True
+
+            # Everything except a possible partial delimiter at the end is body
+            safe = len(self.buffer) - len(self.delimiter) + 1
+            if safe >= size or (safe > 0 and self.remaining <= 0):
+                safe = min(safe, size)
+                data = bytes(self.buffer[:safe])
+                del self.buffer[:safe]
+                return data, False
+            if not self._fill():
+                raise MultipartError("Multipart body ended inside a part")
+
+    def _finish_part(self):
+        """Consume what follows a delimiter: CRLF before another part or '--' at the end"""
+        while len(self.buffer) < 2:
+            if not self._fill():
+                raise MultipartError("Multipart body ended after a delimiter")
+        if self.buffer[:2] == b'--':
+            self.finished = True
+            # Ignore the epilogue without buffering it
+            self.buffer.clear()
+            while self.remaining > 0:
+                data = self.rfile.read(min(self.remaining, STREAM_READ_SIZE))
+                if not data:
+                    break
+                self.remaining -= len(data)
+        else:
+            self._read_until(b'\r\n', MAX_PART_HEADER_SIZE)
+
+    def __iter__(self):
+        # Skip the preamble up to and including the first boundary line
+        self._read_until(self.delimiter[2:], MAX_PART_HEADER_SIZE)
+        self._finish_part()
+        while not self.finished:
+            raw_headers = self._read_until(b'\r\n\r\n', MAX_PART_HEADER_SIZE)
+            headers = email.parser.HeaderParser().parsestr(raw_headers.decode('utf-8', 'replace'))
+            self.current = MultipartPart(self, headers)
+            yield self.current
+            self.current.drain()
+
+# Resumable uploads
+#
+# A client creates a session for a file of known size, then PUTs fixed-size
+# chunks at chunk-aligned offsets, in any order and over as many connections
+# as it likes. Each chunk is sealed into storage segments as it arrives, so no
+# plaintext touches the disk; finalize only concatenates the sealed segments
+# and writes the index. Chunks already on disk survive dropped connections and
+# restarts, and GET on the session tells the client what is still missing.
+UPLOAD_CHUNK_SIZE = 32 * SEGMENT_SIZE  # 8 MiB, always a whole number of segments
+SESSION_DIR = os.path.join('uploads', '.sessions')
+SESSION_ID_CHARS = set('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_')
+
+class UploadSession:
+    """On-disk state of one resumable upload"""
+
+    def __init__(self, session_id, info):
+        self.session_id = session_id
+        self.info = info
+        self.path = os.path.join(SESSION_DIR, session_id)
+        self.header = self.read_header()
+        self.file_key = derive_file_key(bytes.fromhex(info['file_id']), KEYRING[info['key_id']])
+        self.aead = AESGCM(self.file_key)
+
+    @classmethod
+    def create(cls, filename, size, content_hash=None, ttl=FILE_TTL):
+        if not isinstance(size, int) or size < 0 or size > MAX_UPLOAD_SIZE:
+            raise UploadTooLarge("Upload size must be between 0 and 5GB")
+        if content_hash is not None:
+            try:
+                blob_path(content_hash)
+            except ValueError:
+                raise UploadError("sha256 must be 64 lowercase hex digits")
+        session_id = secrets.token_urlsafe(18)
+        info = {
+            'filename': filename,
+            'size': size,
+            'chunk_size': UPLOAD_CHUNK_SIZE,
+            'file_id': os.urandom(16).hex(),
+            'key_id': KEY_ID,
+            'sha256': content_hash,
+            'ttl': ttl,
+            'created': time.time()
+        }
+        session = cls(session_id, info)
+        os.makedirs(session.path)
+        with open(os.path.join(session.path, 'session.json'), 'w') as f:
+            json.dump(info, f)
+        return session
+
+    @classmethod
+    def load(cls, session_id):
+        """Return the session with this id, or None"""
+        if not session_id or not set(session_id) <= SESSION_ID_CHARS:
+            return None
+        try:
+            with open(os.path.join(SESSION_DIR, session_id, 'session.json'), 'r') as f:
+                info = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        # Chunks sealed under a key that is no longer configured can never be read
+        if info.get('key_id') not in KEYRING:
+            return None
+        return cls(session_id, info)
+
+    def read_header(self):
+        try:
+            with open(os.path.join(self.path, 'header'), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def fix_header(self, first_segment):
+        """Return the file header, choosing the codec from first_segment if no chunk has yet.
+
+        Chunks arrive in parallel, so the header is published with a hard link:
+        the first chunk to get here wins and the others use its header.
+        """
+        if self.header is None:
+            header = new_segment_header(*choose_codec(first_segment), file_id=bytes.fromhex(self.info['file_id']),
+                                        key_id=self.info['key_id'])
+            temp_path = os.path.join(self.path, f'.header-{uuid.uuid4().hex}.tmp')
+            with open(temp_path, 'wb') as f:
+                f.write(header)
+            try:
+                os.link(temp_path, os.path.join(self.path, 'header'))
+                self.header = header
+            except FileExistsError:
+                self.header = self.read_header()
+            finally:
+                os.remove(temp_path)
+        return self.header
+
+    @property
+    def size(self):
+        return self.info['size']
+
+    @property
+    def chunk_size(self):
+        return self.info['chunk_size']
+
+    @property
+    def chunk_count(self):
+        return max(1, -(-self.size // self.chunk_size))
+
+    @property
+    def segment_count(self):
+        return max(1, -(-self.size // SEGMENT_SIZE))
+
+    def chunk_length(self, number):
+        return min(self.chunk_size, self.size - number * self.chunk_size)
+
+    def chunk_path(self, number):
+        return os.path.join(self.path, f'{number}.chunk')
+
+    def received_chunks(self):
+        return sorted(int(name[:-6]) for name in os.listdir(self.path) if name.endswith('.chunk'))
+
+    def status(self):
+        received = self.received_chunks()
+        ranges = []
+        for number in received:
+            start, end = number * self.chunk_size, number * self.chunk_size + self.chunk_length(number)
+            if ranges and ranges[-1][1] == start:
+                ranges[-1][1] = end
+            else:
+                ranges.append([start, end])
+        return {
+            'session_id': self.session_id,
+            'filename': self.info['filename'],
+            'size': self.size,
+            'chunk_size': self.chunk_size,
+            'chunk_count': self.chunk_count,
+            'received_ranges': ranges,
+            'missing_chunks': sorted(set(range(self.chunk_count)) - set(received))
+        }
+
+    def write_chunk(self, number, source, length):
+        """Read one chunk from source and store it as sealed segments"""
+        if not 0 <= number < self.chunk_count:
+            raise UploadError("Chunk offset out of range")
+        if length != self.chunk_length(number):
+            raise UploadError(f"Chunk {number} must be exactly {self.chunk_length(number)} bytes")
+
+        first_segment = number * (self.chunk_size // SEGMENT_SIZE)
+        segment_count = max(1, -(-length // SEGMENT_SIZE))
+        remaining = [length]
+
+        def read_segment():
+            started = time.perf_counter()
+            want = min(SEGMENT_SIZE, remaining[0])
+            data = source.read(want) if want else b''
+            while len(data) < want:
+                more = source.read(want - len(data))
+                if not more:
+                    raise UploadError("Connection closed before the chunk finished")
+                data += more
+            remaining[0] -= want
+            metrics.observe('bt_upload_stage_seconds', time.perf_counter() - started, ('parse',))
+            return data
+
+        data = read_segment()
+        header = self.fix_header(data)
+        codec, level, _segment_size, _file_id, _key_id = parse_segment_header(header)
+
+        def read_segments(data):
+            for index in range(first_segment, first_segment + segment_count):
+                if index > first_segment:
+                    data = read_segment()
+                yield (self.file_key, header, index, data, codec, level, index == self.segment_count - 1)
+
+        temp_path = os.path.join(self.path, f'.{number}-{uuid.uuid4().hex}.tmp')
+        try:
+            with open(temp_path, 'wb') as f:
+                for sealed in map_codec_jobs(seal_segment_job, read_segments(data)):
+                    started = time.perf_counter()
+                    f.write(len(sealed).to_bytes(4, 'big') + sealed)
+                    metrics.observe('bt_upload_stage_seconds', time.perf_counter() - started, ('write',))
+            os.replace(temp_path, self.chunk_path(number))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        # Keep the session alive while chunks keep arriving
+        os.utime(os.path.join(self.path, 'session.json'))
+
+    def finalize(self, filepath):
+        """Assemble the stored file at filepath, or the next free name, from the received chunks.
+        Returns (metadata, filepath)
+
+        Segments are opened again on the codec pool while they are copied so
+        the content hash covers exactly what was stored.
+        """
+        missing = self.status()['missing_chunks']
+        if missing:
+            raise UploadError(f"Missing chunks: {missing[:20]}")
+
+        temp_path = os.path.join(os.path.dirname(filepath), f".upload-{uuid.uuid4().hex}.part")
+        segment_lengths = []
+        content_hash = hashlib.sha256()
+        codec, level, _segment_size, _file_id, _key_id = parse_segment_header(self.header)
+
+        def read_segments(out):
+            for number in range(self.chunk_count):
+                with open(self.chunk_path(number), 'rb') as f:
+                    while True:
+                        length_bytes = f.read(4)
+                        if not length_bytes:
+                            break
+                        sealed = f.read(int.from_bytes(length_bytes, 'big'))
+                        index = len(segment_lengths)
+                        segment_lengths.append(len(sealed))
+                        out.write(sealed)
+                        yield (self.file_key, self.header, index, sealed, codec, index == self.segment_count - 1,
+                               'upload')
+
+        try:
+            with open(temp_path, 'wb') as out:
+                out.write(self.header)
+                for data in map_codec_jobs(open_segment_job, read_segments(out)):
+                    content_hash.update(data)
+                content_hash = content_hash.hexdigest()
+                if self.info.get('sha256') and content_hash != self.info['sha256']:
+                    raise UploadError("Uploaded content does not match the declared sha256")
+                metadata = segment_metadata(self.info['filename'], codec, level, self.size,
+                                            segment_lengths, content_hash)
+                out.write(seal_segment_index(self.aead, self.header, metadata, segment_lengths))
+            filepath = move_to_free_path(temp_path, filepath)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self.delete()
+        return metadata, filepath
+
+    def delete(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+def remove_stale_sessions(max_idle=FILE_TTL):
+    """Delete upload sessions that have not received a chunk for max_idle seconds"""
+    if not os.path.isdir(SESSION_DIR):
+        return
+    now = time.time()
+    for session_id in os.listdir(SESSION_DIR):
+        info_path = os.path.join(SESSION_DIR, session_id, 'session.json')
+        try:
+            idle = now - os.path.getmtime(info_path)
+        except OSError:
+            idle = max_idle + 1
+        if idle > max_idle:
+            shutil.rmtree(os.path.join(SESSION_DIR, session_id), ignore_errors=True)
+            print(f"🗑️ Removed stale upload session: {session_id}")
+
+def parse_ttl(value):
+    """Validate a client-requested lifetime in seconds"""
+    try:
+        ttl = int(value)
+    except (TypeError, ValueError):
+        raise UploadError("ttl must be a whole number of seconds")
+    if not MIN_FILE_TTL <= ttl <= FILE_TTL:
+        raise UploadError(f"ttl must be between {MIN_FILE_TTL} and {FILE_TTL} seconds")
+    return ttl
+
+def remove_stored_file(filename, upload_dir='uploads', reason='delete', expired_by=None):
+    """Delete a stored file, its owner token and its catalog entry. Returns False if it was left alone.
+
+    With expired_by the file is only deleted if its catalog entry says it has
+    expired by then and no other worker has claimed it first.
+    """
+    filepath = os.path.join(upload_dir, filename)
+    entry = catalog.remove(filename, reason, expired_by)
+    if entry is None and expired_by is not None:
+        return False
+    file_id = segment_file_id(filepath)
+    if file_id:
+        segment_cache.invalidate(file_id)
+    for path in (filepath, f"{filepath}.token"):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    if entry and entry['content_hash']:
+        release_blob(entry['content_hash'])
+    return True
+
+HOUSEKEEPING_INTERVAL = 3600  # Seconds between sweeps of upload sessions and orphaned blobs
+
+class ExpiryScheduler(threading.Thread):
+    """Delete each stored file at its deadline.
+
+    Deadlines sit in a min-heap seeded from the catalog, so the thread sleeps
+    until the earliest one and only ever touches files that are due. Deleted
+    or replaced entries are not removed from the heap; when their deadline
+    comes up the catalog no longer agrees and the entry is skipped.
+    """
+
+    def __init__(self):
+        super().__init__(name='bt-expiry')
+        self.heap = []
+        self.condition = threading.Condition()
+
+    def schedule(self, filename, expires_at):
+        with self.condition:
+            heapq.heappush(self.heap, (expires_at, filename))
+            if self.heap[0] == (expires_at, filename):
+                self.condition.notify()
+
+    def run(self):
+        with self.condition:
+            self.heap = [(expires_at, name) for name, expires_at in catalog.expiry_times().items()]
+            heapq.heapify(self.heap)
+        next_housekeeping = 0
+        while True:
+            try:
+                if time.time() >= next_housekeeping:
+                    next_housekeeping = time.time() + HOUSEKEEPING_INTERVAL
+                    started = time.perf_counter()
+                    remove_stale_sessions()
+                    collect_orphan_blobs()
+                    catalog.prune_changes(time.time() - CHANGE_RETENTION)
+                    metrics.observe('bt_housekeeping_seconds', time.perf_counter() - started)
+                for filename in self.pop_due(next_housekeeping):
+                    if remove_stored_file(filename, reason='expire', expired_by=time.time()):
+                        metrics.inc('bt_expired_files_total')
+                        print(f"🗑️ Auto-deleted (expired): {filename}")
+            except Exception as e:
+                print(f"⚠️ Expiry error: {e}")
+
+    def pop_due(self, wake_by):
+        """Sleep until a deadline passes (or until wake_by), then pop every due filename"""
+        with self.condition:
+            while True:
+                now = time.time()
+                if self.heap and self.heap[0][0] <= now:
+                    due = []
+                    while self.heap and self.heap[0][0] <= now:
+                        due.append(heapq.heappop(self.heap)[1])
+                    return due
+                if now >= wake_by:
+                    return []
+                self.condition.wait(min(self.heap[0][0] if self.heap else wake_by, wake_by) - now)
+
+expiry = ExpiryScheduler()
+expiry.daemon = True
+
+# Persistent connections
+#
+# Responses are HTTP/1.1 and every one is framed, by Content-Length or chunked
+# transfer encoding, so the polling UI and API clients reuse one connection
+# instead of paying a TCP/TLS handshake per request. A connection is closed
+# after KEEPALIVE_TIMEOUT idle seconds, after MAX_KEEPALIVE_REQUESTS requests,
+# or when a request body was left unread and cannot be cheaply skipped.
+KEEPALIVE_TIMEOUT = 15  # Idle seconds to wait for the next request
+REQUEST_TIMEOUT = 120  # Seconds a request may stall while its head or body is sent
+MAX_KEEPALIVE_REQUESTS = 100  # Requests per connection
+MAX_BODY_DRAIN = 64 * 1024  # Unread body bytes skipped to keep the connection
+
+class RequestBody:
+    """File-like view of one request body that stops at its Content-Length.
+
+    throttle, if given, is called with the size of every read to pace it.
+    """
+
+    def __init__(self, source, length, throttle=None):
+        self.source = source
+        self.remaining = length
+        self.throttle = throttle
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if size <= 0:
+            return b''
+        data = self.source.read(size)
+        self.remaining = self.remaining - len(data) if data else 0
+        if data:
+            metrics.inc('bt_received_bytes_total', amount=len(data))
+            if self.throttle:
+                self.throttle(len(data))
+        return data
+
+    def drain(self, limit):
+        """Skip up to limit unread bytes. Returns True if the whole body has been read"""
+        while 0 < self.remaining <= limit:
+            limit -= len(self.read(min(self.remaining, STREAM_READ_SIZE)))
+        return self.remaining == 0
+
+# Admission control
+#
+# Requests are admitted through two lanes, each with a fixed number of
+# requests running at once and a bounded queue behind them. Bulk requests
+# (uploads, chunk PUTs, finalize, downloads, previews) can take seconds of
+# CPU and I/O each; everything else (the file list, health, analytics, static
+# assets, session status) is light, so polling never waits behind transfers.
+# Change feed requests stay open until something changes, so they get a third
+# lane of their own with no queue: they never hold up light requests, and once
+# BT_MAX_WATCHERS are open more are turned away until one closes.
+# A full queue is answered with 503 and a client with too many requests in a
+# lane with 429, both with Retry-After. Open connections are capped as well.
+# Clients are told apart by address, or by X-Forwarded-For behind a proxy
+# that sets it ($BT_TRUST_PROXY=1).
+MAX_CONNECTIONS = int(os.environ.get('BT_MAX_CONNECTIONS', 1024))
+ADMISSION_TIMEOUT = 30  # Seconds a request may wait in its lane's queue
+RETRY_AFTER = 5  # Seconds clients are asked to wait when turned away
+TRUST_PROXY = os.environ.get('BT_TRUST_PROXY') == '1'
+BUSY_RESPONSE = (b'HTTP/1.1 503 Service Unavailable\r\nRetry-After: 5\r\nContent-Type: text/plain\r\n'
+                 b'Content-Length: 21\r\nConnection: close\r\n\r\nServer is overloaded\n')
+
+class Overloaded(Exception):
+    """A request that cannot be admitted now (answered with status and Retry-After)"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class AdmissionLane:
+    """One lane: how many requests may run, how many may wait, and how many per client"""
+
+    def __init__(self, name, workers, queue_limit, per_client):
+        self.name = name
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.per_client = per_client
+        self.active = 0
+        self.waiting = collections.deque()  # (ticket, client) in arrival order
+        self.clients = collections.Counter()  # Running plus waiting requests per client
+        self.admitted = 0
+        self.rejected = 0
+
+class RequestScheduler:
+    """Admit requests into lanes in arrival order.
+
+    enter() hands out a ticket (a Future) that completes when the request
+    may run; release() frees its slot for the next waiting ticket. admit()
+    waits for a ticket on the calling thread and admit_async() on the event
+    loop, so both engines share the same lanes.
+    """
+
+    def __init__(self, lanes):
+        self.lanes = {lane.name: lane for lane in lanes}
+        self.lock = threading.Lock()
+
+    def enter(self, lane_name, client):
+        lane = self.lanes[lane_name]
+        ticket = Future()
+        with self.lock:
+            if lane.clients[client] >= lane.per_client:
+                lane.rejected += 1
+                raise Overloaded(429, "Too many concurrent requests from this client")
+            if lane.active < lane.workers and not lane.waiting:
+                lane.active += 1
+                lane.admitted += 1
+                ticket.set_result(None)
+            elif len(lane.waiting) >= lane.queue_limit:
+                lane.rejected += 1
+                raise Overloaded(503, "Server is busy")
+            else:
+                lane.waiting.append((ticket, client))
+            lane.clients[client] += 1
+        return ticket
+
+    def release(self, lane_name, client):
+        lane = self.lanes[lane_name]
+        with self.lock:
+            lane.clients[client] -= 1
+            if not lane.clients[client]:
+                del lane.clients[client]
+            lane.active -= 1
+            while lane.waiting and lane.active < lane.workers:
+                ticket, _ = lane.waiting.popleft()
+                lane.active += 1
+                lane.admitted += 1
+                ticket.set_result(None)
+
+    def cancel(self, lane_name, client, ticket):
+        """Withdraw a ticket that waited too long, releasing its slot if it was granted meanwhile"""
+        lane = self.lanes[lane_name]
+        with self.lock:
+            if (ticket, client) in lane.waiting:
+                lane.waiting.remove((ticket, client))
+                lane.clients[client] -= 1
+                if not lane.clients[client]:
+                    del lane.clients[client]
+                lane.rejected += 1
+                return
+        self.release(lane_name, client)
+
+    def admit(self, lane_name, client, timeout=ADMISSION_TIMEOUT):
+        """Block until the request may run. Raises Overloaded"""
+        ticket = self.enter(lane_name, client)
+        try:
+            ticket.result(timeout)
+        except TimeoutError:
+            self.cancel(lane_name, client, ticket)
+            raise Overloaded(503, "Server is busy")
+
+    async def admit_async(self, lane_name, client, timeout=ADMISSION_TIMEOUT):
+        ticket = self.enter(lane_name, client)
+        try:
+            # shield: a timeout must not cancel the ticket, which release() may be granting
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(ticket)), timeout)
+        except TimeoutError:
+            self.cancel(lane_name, client, ticket)
+            raise Overloaded(503, "Server is busy")
+
+    def stats(self):
+        with self.lock:
+            return {lane.name: {'workers': lane.workers, 'active': lane.active, 'waiting': len(lane.waiting),
+                                'admitted': lane.admitted, 'rejected': lane.rejected}
+                    for lane in self.lanes.values()}
+
+def request_lane(method, path):
+    """'bulk' for requests that move file contents, 'watch' for the change feed, 'light' for everything else"""
+    path = path.partition('?')[0]
+    if method == 'GET' and path == '/files/changes':
+        return 'watch'
+    if method == 'GET' and (path == '/archive' or path.startswith(('/download/', '/preview/'))):
+        return 'bulk'
+    if method == 'PUT' or (method == 'POST' and (path in ('/upload', '/archive') or path.endswith('/finalize'))):
+        return 'bulk'
+    return 'light'
+
+scheduler = RequestScheduler([
+    AdmissionLane('light', workers=16, queue_limit=256, per_client=32),
+    AdmissionLane('bulk', workers=int(os.environ.get('BT_BULK_WORKERS', max(8, 2 * (os.cpu_count() or 1)))),
+                  queue_limit=64, per_client=int(os.environ.get('BT_MAX_PER_CLIENT', 8))),
+    AdmissionLane('watch', workers=int(os.environ.get('BT_MAX_WATCHERS', 64)), queue_limit=0, per_client=8),
+])
+
+def lane_metric(field):
+    return lambda: [((name,), lane[field]) for name, lane in scheduler.stats().items()]
+
+metrics.register('gauge', 'bt_lane_active', 'Requests running in each admission lane', ('lane',),
+                 collect=lane_metric('active'))
+metrics.register('gauge', 'bt_lane_waiting', 'Requests queued in each admission lane', ('lane',),
+                 collect=lane_metric('waiting'))
+metrics.register('counter', 'bt_lane_rejected_total', 'Requests turned away with 429 or 503', ('lane',),
+                 collect=lane_metric('rejected'))
+
+# Metric labels: fixed paths are their own route, the rest are named by prefix
+METRIC_ROUTES = {'/', '/index.html', '/manifest.json', '/sw.js', '/files', '/analytics', '/health', '/metrics',
+                 '/upload', '/upload/sessions', '/admin/bandwidth', '/archive', '/files/changes'}
+METRIC_ROUTE_PREFIXES = (('/upload/sessions/', '/upload/sessions/{id}'), ('/blobs/', '/blobs/{sha256}'),
+                         ('/download/', '/download/{name}'), ('/preview/', '/preview/{name}'),
+                         ('/delete/', '/delete/{name}'))
+METRIC_METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'DELETE'}
+
+def route_label(path):
+    """The route a request path is counted under, so labels stay few"""
+    path = path.partition('?')[0]
+    if path in METRIC_ROUTES:
+        return path
+    if path.startswith('/upload/sessions/') and path.endswith('/finalize'):
+        return '/upload/sessions/{id}/finalize'
+    for prefix, route in METRIC_ROUTE_PREFIXES:
+        if path.startswith(prefix):
+            return route
+    return 'other'
+
+# Bandwidth shaping
+#
+# Response bodies of downloads and previews and every request body are paced
+# by token buckets at three levels: per connection, per client and overall,
+# each with its own rate for each direction (0 means unlimited). A transfer
+# waits for the slowest of its buckets, so one phone pulling a large video
+# cannot take the whole link. Defaults come from $BT_BANDWIDTH, e.g.
+# "download.client=10M,upload.global=50M" (bytes per second); changes made at
+# runtime through /admin/bandwidth are stored in the database, where every
+# worker process picks them up.
+BANDWIDTH_DIRECTIONS = ('download', 'upload')
+BANDWIDTH_SCOPES = ('connection', 'client', 'global')
+BANDWIDTH_REFRESH_INTERVAL = 5  # Seconds between checks for limits changed by another process
+BANDWIDTH_CLIENT_IDLE = 3600  # Seconds before an idle client's buckets and counters are dropped
+ADMIN_TOKEN = os.environ.get('BT_ADMIN_TOKEN')
+
+def parse_rate(value):
+    """Bytes per second from an int or a string like '512K' or '10M'"""
+    if isinstance(value, bool):
+        raise ValueError("Rate must be a number of bytes per second")
+    if isinstance(value, (int, float)):
+        rate = value
+    else:
+        text = str(value).strip().upper()
+        scale = 1024 ** (' KMG'.index(text[-1])) if text and text[-1] in 'KMG' else 1
+        rate = float(text.rstrip('KMG') or 'x') * scale
+    if not math.isfinite(rate):
+        raise ValueError("Rate must be a finite number of bytes per second")
+    if rate < 0:
+        raise ValueError("Rate cannot be negative")
+    return int(rate)
+
+def parse_bandwidth_spec(spec):
+    """{'download': {'client': 10485760}, ...} from 'download.client=10M,...'"""
+    limits = {}
+    for item in filter(None, (part.strip() for part in (spec or '').split(','))):
+        name, _, rate = item.partition('=')
+        direction, _, scope = name.strip().partition('.')
+        if direction not in BANDWIDTH_DIRECTIONS or scope not in BANDWIDTH_SCOPES:
+            raise ValueError(f"Unknown bandwidth limit: {name}")
+        limits.setdefault(direction, {})[scope] = parse_rate(rate)
+    return limits
+
+class TokenBucket:
+    """Tokens refill at the rate passed to consume(); a bucket can hold one second's worth"""
+
+    def __init__(self):
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, nbytes, rate):
+        """Take nbytes. Returns how long to wait before sending them"""
+        with self.lock:
+            now = time.monotonic()
+            if rate <= 0:
+                self.tokens, self.updated = 0.0, now
+                return 0.0
+            burst = max(rate, STREAM_READ_SIZE)
+            self.tokens = min(burst, self.tokens + (now - self.updated) * rate) - nbytes
+            self.updated = now
+            return -self.tokens / rate if self.tokens < 0 else 0.0
+
+class BandwidthShaper:
+    """Token-bucket rate limits per connection, per client and overall, with counters"""
+
+    def __init__(self, db_path='analytics.db'):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.limits = {direction: {scope: 0 for scope in BANDWIDTH_SCOPES} for direction in BANDWIDTH_DIRECTIONS}
+        self.global_buckets = {direction: TokenBucket() for direction in BANDWIDTH_DIRECTIONS}
+        self.clients = {}  # client -> {'buckets', 'counters', 'seen'}
+        self.totals = collections.Counter()
+        self.next_refresh = 0.0
+        self.init_db()
+        self.apply(parse_bandwidth_spec(os.environ.get('BT_BANDWIDTH')))
+        self.refresh()
+
+    def init_db(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)')
+        conn.commit()
+        conn.close()
+
+    def apply(self, changes):
+        """Validate and apply {'direction': {'scope': rate}}. Returns the normalized changes"""
+        normalized = {}
+        for direction, scopes in changes.items():
+            if direction not in BANDWIDTH_DIRECTIONS or not isinstance(scopes, dict):
+                raise ValueError(f"Unknown bandwidth direction: {direction}")
+            for scope, rate in scopes.items():
+                if scope not in BANDWIDTH_SCOPES:
+                    raise ValueError(f"Unknown bandwidth scope: {scope}")
+                normalized.setdefault(direction, {})[scope] = parse_rate(rate)
+        with self.lock:
+            for direction, scopes in normalized.items():
+                self.limits[direction].update(scopes)
+        return normalized
+
+    def set_limits(self, changes):
+        """Change limits at runtime and store them for the other worker processes"""
+        self.apply(changes)
+        with self.lock:
+            value = json.dumps(self.limits)
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('INSERT INTO settings (name, value) VALUES (?, ?) '
+                     'ON CONFLICT(name) DO UPDATE SET value = excluded.value', ('bandwidth', value))
+        conn.commit()
+        conn.close()
+
+    def refresh(self):
+        """Pick up stored limits and forget clients that have gone quiet"""
+        conn = sqlite3.connect(self.db_path)
+        row = conn.execute("SELECT value FROM settings WHERE name = 'bandwidth'").fetchone()
+        conn.close()
+        if row:
+            self.apply(json.loads(row[0]))
+        cutoff = time.monotonic() - BANDWIDTH_CLIENT_IDLE
+        with self.lock:
+            for client in [c for c, state in self.clients.items() if state['seen'] < cutoff]:
+                del self.clients[client]
+
+    def connection_buckets(self):
+        """Buckets for one connection, to pass to throttle() for everything sent over it"""
+        return {direction: TokenBucket() for direction in BANDWIDTH_DIRECTIONS}
+
+    def throttle(self, direction, client, connection_buckets, nbytes):
+        """Count nbytes for client and sleep until every bucket they pass through allows them"""
+        now = time.monotonic()
+        if now >= self.next_refresh:
+            self.next_refresh = now + BANDWIDTH_REFRESH_INTERVAL
+            try:
+                self.refresh()
+            except sqlite3.Error as e:
+                print(f"⚠️ Could not refresh bandwidth limits: {e}")
+        with self.lock:
+            limits = self.limits[direction]
+            state = self.clients.get(client)
+            if state is None:
+                state = self.clients[client] = {
+                    'buckets': {d: TokenBucket() for d in BANDWIDTH_DIRECTIONS},
+                    'counters': collections.Counter(), 'seen': now}
+            state['seen'] = now
+            state['counters'][f'{direction}_bytes'] += nbytes
+            self.totals[f'{direction}_bytes'] += nbytes
+        wait = max(connection_buckets[direction].consume(nbytes, limits['connection']),
+                   state['buckets'][direction].consume(nbytes, limits['client']),
+                   self.global_buckets[direction].consume(nbytes, limits['global']))
+        if wait > 0:
+            with self.lock:
+                state['counters'][f'{direction}_throttled_seconds'] += wait
+                state['counters'][f'{direction}_throttled'] += 1
+                self.totals[f'{direction}_throttled_seconds'] += wait
+                self.totals[f'{direction}_throttled'] += 1
+            time.sleep(wait)
+
+    def stats(self):
+        """Limits, totals and per-client counters, most throttled clients first"""
+        with self.lock:
+            clients = [dict(state['counters'], client=client) for client, state in self.clients.items()]
+            limits = {direction: dict(scopes) for direction, scopes in self.limits.items()}
+            totals = dict(self.totals)
+        clients.sort(key=lambda c: -(c.get('download_throttled_seconds', 0) + c.get('upload_throttled_seconds', 0)))
+        for counters in [totals] + clients:
+            for key in list(counters):
+                if key.endswith('_seconds'):
+                    counters[key] = round(counters[key], 3)
+        return {'limits': limits, 'totals': totals, 'clients': clients}
+
+shaper = BandwidthShaper()
+metrics.register('counter', 'bt_throttled_seconds_total', 'Time transfers were held back by bandwidth limits',
+                 ('direction',), collect=lambda: [((d,), round(shaper.totals[f'{d}_throttled_seconds'], 3))
+                                                  for d in BANDWIDTH_DIRECTIONS])
+
+# Streaming ZIP archives
+#
+# GET /archive?file=a&file=b (or POST /archive {"files": [...]}, or a form
+# with a names field per file) sends several stored files as one ZIP that is
+# built while it is sent. Each member is decoded segment by segment and
+# deflated on the way out, unless its content was stored uncompressed because
+# it already is compressed; then it is stored. CRCs and sizes follow each
+# member in a data descriptor, so nothing is buffered or written to disk, and
+# ZIP64 records are used for members and archives past 4 GiB.
+MAX_ARCHIVE_FILES = 1000
+ARCHIVE_DEFLATE_LEVEL = 1  # On a LAN the CPU, not the link, is what deflate competes with
+ZIP64_LIMIT = (1 << 32) - 1  # Sizes and offsets from here on need ZIP64 fields
+ZIP_FLAGS = 0x08 | 0x800  # Sizes and CRC in a data descriptor; UTF-8 names
+
+def zip_dos_time(timestamp):
+    """(time, date) fields of a ZIP header"""
+    t = time.localtime(max(timestamp, 315532800))  # ZIP dates start in 1980
+    return t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2, (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+
+def iter_zip(members):
+    """Yield a ZIP archive of members, (name, size, mtime, deflate, chunks) tuples.
+
+    chunks() returns an iterator over the member's bytes; it is only called
+    when the member's turn comes. size decides up front whether the member
+    needs ZIP64 fields.
+    """
+    offset = 0
+    central = []
+    for name, size, mtime, deflate, chunks in members:
+        encoded = name.encode()
+        # Deflate can grow incompressible data slightly, as zipfile also allows for
+        zip64 = size * 1.05 > ZIP64_LIMIT
+        method = zlib.DEFLATED if deflate else 0
+        dos_time, dos_date = zip_dos_time(mtime)
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0) if zip64 else b''
+        header = struct.pack('<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, ZIP_FLAGS, method, dos_time, dos_date,
+                             0, 0xFFFFFFFF if zip64 else 0, 0xFFFFFFFF if zip64 else 0, len(encoded), len(extra))
+        yield header + encoded + extra
+        local_offset = offset
+        offset += len(header) + len(encoded) + len(extra)
+
+        crc = compressed_size = original_size = 0
+        compressor = zlib.compressobj(ARCHIVE_DEFLATE_LEVEL, zlib.DEFLATED, -15) if deflate else None
+        for data in chunks():
+            crc = zlib.crc32(data, crc)
+            original_size += len(data)
+            if compressor:
+                data = compressor.compress(data)
+            if data:
+                compressed_size += len(data)
+                yield data
+        if compressor:
+            data = compressor.flush()
+            compressed_size += len(data)
+            yield data
+        if zip64:
+            descriptor = struct.pack('<IIQQ', 0x08074b50, crc, compressed_size, original_size)
+        elif max(compressed_size, original_size) >= ZIP64_LIMIT:
+            raise ValueError(f"{name} is larger than its recorded size")
+        else:
+            descriptor = struct.pack('<IIII', 0x08074b50, crc, compressed_size, original_size)
+        yield descriptor
+        offset += compressed_size + len(descriptor)
+        central.append((encoded, method, dos_time, dos_date, crc, compressed_size, original_size, local_offset,
+                        zip64 or local_offset >= ZIP64_LIMIT))
+
+    directory_offset = offset
+    for encoded, method, dos_time, dos_date, crc, compressed_size, original_size, local_offset, zip64 in central:
+        if zip64:
+            extra = struct.pack('<HHQQQ', 1, 24, original_size, compressed_size, local_offset)
+            compressed_size = original_size = local_offset = 0xFFFFFFFF
+        else:
+            extra = b''
+        version = 45 if zip64 else 20
+        record = struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 3 << 8 | version, version, ZIP_FLAGS, method,
+                             dos_time, dos_date, crc, compressed_size, original_size, len(encoded), len(extra),
+                             0, 0, 0, 0o100644 << 16, local_offset)
+        yield record + encoded + extra
+        offset += len(record) + len(encoded) + len(extra)
 
-class FileCleaner(threading.Thread):
-    def run(self):
-        while True:
-            try:
-                now = time.time()
-                if os.path.exists('uploads'):
-                    for filename in os.listdir('uploads'):
-                        filepath = os.path.join('uploads', filename)
-                        if os.path.isfile(filepath):
-                            # Check if file is older than 24 hours
-                            file_age = now - os.path.getctime(filepath)
-                            if file_age > 86400:  # 24 hours in seconds
-                                os.remove(filepath)
-                                # Also remove associated token file
-                                token_path = f"{filepath}.token"
-                                if os.path.exists(token_path):
-                                    os.remove(token_path)
-                                print(f"🗑️ Auto-deleted (24h): {filename}")
-            except Exception as e:
-                print(f"⚠️ Cleaner error: {e}")
-            time.sleep(3600)  # Check every hour
+    directory_size = offset - directory_offset
+    count = len(central)
+    if count >= 0xFFFF or directory_offset >= ZIP64_LIMIT or directory_size >= ZIP64_LIMIT:
+        yield struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count, directory_size, directory_offset)
+        yield struct.pack('<IIQI', 0x07064b50, 0, offset, 1)
+    yield struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                      min(directory_size, 0xFFFFFFFF), min(directory_offset, 0xFFFFFFFF), 0)
+
+# Static assets
+#
+# The app shell (index.html, manifest.json, sw.js) is read once, with a gzip
+# copy made up front, and served from memory. The file is read again when its
+# mtime changes, which is checked at most once a second, so an edit is live
+# without a restart. Every response carries a strong ETag per encoding and
+# Cache-Control: no-cache, so browsers revalidate each time and an unchanged
+# asset costs a 304 with no body.
+STATIC_RECHECK_INTERVAL = 1.0  # Seconds between mtime checks of an asset
+
+class StaticAsset:
+    """One app file held in memory as identity and gzip bodies"""
 
-# Start cleaner thread
-cleaner = FileCleaner()
-cleaner.daemon = True
-cleaner.start()
+    def __init__(self, filename, content_type):
+        self.filename = filename
+        self.content_type = content_type
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.checked = float('-inf')
+        self.variants = None  # {'identity': (body, etag), 'gzip': (body, etag)}
+
+    def current(self):
+        """Return the variants, reloading the file if it changed. Raises FileNotFoundError"""
+        if time.monotonic() - self.checked >= STATIC_RECHECK_INTERVAL:
+            with self.lock:
+                now = time.monotonic()
+                if now - self.checked >= STATIC_RECHECK_INTERVAL:
+                    mtime = os.stat(self.filename).st_mtime_ns
+                    if mtime != self.mtime:
+                        self.load(mtime)
+                    self.checked = now
+        return self.variants
+
+    def load(self, mtime):
+        with open(self.filename, 'rb') as f:
+            body = f.read()
+        tag = hashlib.sha256(body).hexdigest()[:32]
+        gzip_body = gzip.compress(body, 9, mtime=0)
+        variants = {'identity': (body, f'"{tag}"')}
+        if len(gzip_body) < len(body):
+            variants['gzip'] = (gzip_body, f'"{tag}-gzip"')
+        self.variants = variants
+        self.mtime = mtime
+
+index_asset = StaticAsset('index.html', 'text/html; charset=utf-8')
+static_assets = {
+    '/': index_asset,
+    '/index.html': index_asset,
+    '/manifest.json': StaticAsset('manifest.json', 'application/json'),
+    '/sw.js': StaticAsset('sw.js', 'application/javascript'),
+}
+
+def load_static_assets():
+    """Read every asset ahead of the first request. Returns how many were found"""
+    loaded = 0
+    for asset in set(static_assets.values()):
+        try:
+            asset.current()
+            loaded += 1
+        except FileNotFoundError:
+            pass
+    return loaded
 
 class FileTransferHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; with Nagle on, a kept-alive
+    # connection waits out the client's delayed ACK before every response body
+    disable_nagle_algorithm = True
+
     def __init__(self, *args, **kwargs):
         self.upload_dir = "uploads"
+        self.requests_served = 0
+        self.lane = None
+        self.route = None
+        self.connection_buckets = shaper.connection_buckets()
         if not os.path.exists(self.upload_dir):
             os.makedirs(self.upload_dir)
         super().__init__(*args, **kwargs)
@@ -179,19 +2770,158 @@ class FileTransferHandler(BaseHTTPRequestHandler):
         """Override to reduce console spam"""
         return
     
+    def handle_one_request(self):
+        """Serve the next request on this connection (threaded engine)"""
+        connection_rfile = self.rfile
+        self.connection.settimeout(KEEPALIVE_TIMEOUT)
+        try:
+            super().handle_one_request()
+            if isinstance(self.rfile, RequestBody):
+                self.finish_request_body()
+        finally:
+            self.rfile = connection_rfile
+            if self.lane:
+                scheduler.release(self.lane, self.client)
+                self.lane = None
+            if self.route:
+                self.record_request()
+    
+    def parse_request(self):
+        """Parse the request head, then limit rfile to the request's body"""
+        self.request_started = time.perf_counter()
+        if self.request is not None:
+            self.connection.settimeout(REQUEST_TIMEOUT)
+        if not super().parse_request():
+            return False
+        self.requests_served += 1
+        self.route = route_label(self.path)
+        self.status = None
+        metrics.inc('bt_requests_in_flight')
+        if 'Transfer-Encoding' in self.headers:
+            self.send_error(411, "Length Required: Chunked request bodies are not supported")
+            return False
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length < 0:
+                raise ValueError
+        except ValueError:
+            self.send_error(400, "Bad Request: Invalid Content-Length")
+            return False
+        self.client = self.client_id()
+        self.rfile = RequestBody(self.rfile, length, self.throttle_upload)
+        if self.request is not None:
+            # Threaded engine: wait for a slot on this connection's own thread
+            return self.admit()
+        return True
+    
+    def send_response(self, code, message=None):
+        self.status = code
+        super().send_response(code, message)
+    
+    def record_request(self):
+        """Count the request that just finished and how long it took"""
+        method = self.command if self.command in METRIC_METHODS else 'other'
+        metrics.inc('bt_requests_total', (self.route, method, self.status or 0))
+        metrics.observe('bt_request_duration_seconds', time.perf_counter() - self.request_started, (self.route,))
+        metrics.inc('bt_requests_in_flight', amount=-1)
+        self.route = None
+    
+    def client_id(self):
+        """The address admission limits are counted against"""
+        forwarded = self.headers.get('X-Forwarded-For') if TRUST_PROXY else None
+        if forwarded:
+            # The proxy appends the address it saw; earlier entries are the client's say-so
+            return forwarded.split(',')[-1].strip()
+        return self.client_address[0]
+    
+    def admit(self):
+        """Wait for a slot in this request's lane. Answers 503/429 and returns False if there is none"""
+        lane = request_lane(self.command, self.path)
+        try:
+            scheduler.admit(lane, self.client)
+        except Overloaded as e:
+            self.send_overloaded(e)
+            return False
+        self.lane = lane
+        return True
+    
+    def throttle_upload(self, nbytes):
+        shaper.throttle('upload', self.client, self.connection_buckets, nbytes)
+    
+    def write_body(self, data):
+        """Write part of a response body, paced by the download limits"""
+        view = memoryview(data)
+        for start in range(0, len(view), STREAM_READ_SIZE):
+            piece = view[start:start + STREAM_READ_SIZE]
+            shaper.throttle('download', self.client, self.connection_buckets, len(piece))
+            started = time.perf_counter()
+            self.wfile.write(piece)
+            metrics.observe('bt_download_stage_seconds', time.perf_counter() - started, ('send',))
+            metrics.inc('bt_sent_bytes_total', amount=len(piece))
+    
+    def send_failure(self, code=500, message=None):
+        """send_error, unless a response is already under way.
+
+        Then its status line and part of its body have gone out, and closing
+        the connection short of the promised length is the only way left to
+        tell the client the body is incomplete.
+        """
+        if self.status is not None:
+            self.close_connection = True
+            return
+        self.send_error(code, message)
+    
+    def send_overloaded(self, error):
+        self.send_json(error.status, {"status": "error", "message": str(error), "retry_after": RETRY_AFTER},
+                       [('Retry-After', str(RETRY_AFTER))])
+    
+    def handle_expect_100(self):
+        """Answer Expect: 100-continue at once, before the body is read"""
+        self.send_response_only(100)
+        BaseHTTPRequestHandler.end_headers(self)
+        return True
+    
+    def finish_request_body(self):
+        """Skip what the route left of the body, or give up on the connection"""
+        if not self.close_connection and not self.rfile.drain(MAX_BODY_DRAIN):
+            self.close_connection = True
+    
+    def end_headers(self):
+        if not self.close_connection:
+            # Routes read the body before they respond, so a large unread rest never will be
+            unread = self.rfile.remaining if isinstance(self.rfile, RequestBody) else 0
+            if self.requests_served >= MAX_KEEPALIVE_REQUESTS or unread > MAX_BODY_DRAIN:
+                self.send_header('Connection', 'close')
+            else:
+                if self.request_version == 'HTTP/1.0':
+                    self.send_header('Connection', 'keep-alive')
+                self.send_header('Keep-Alive', f'timeout={KEEPALIVE_TIMEOUT}, '
+                                               f'max={MAX_KEEPALIVE_REQUESTS - self.requests_served}')
+        super().end_headers()
+    
     def do_GET(self):
-        if self.path == '/' or self.path == '/index.html':
-            self.serve_file('index.html', 'text/html')
-        elif self.path == '/manifest.json':
-            self.serve_file('manifest.json', 'application/json')
-        elif self.path == '/sw.js':
-            self.serve_file('sw.js', 'application/javascript')
+        if self.path in static_assets:
+            self.serve_static(static_assets[self.path])
         elif self.path == '/files':
             self.list_files()
+        elif self.path.startswith('/files?'):
+            self.list_files_page(parse_qs(self.path[7:]))  # Remove '/files?'
+        elif self.path == '/files/changes' or self.path.startswith('/files/changes?'):
+            self.watch_files(parse_qs(self.path.partition('?')[2]))
         elif self.path == '/analytics':
             self.get_analytics()
         elif self.path == '/health':
             self.health_check()
+        elif self.path == '/metrics':
+            self.get_metrics()
+        elif self.path.startswith('/upload/sessions/'):
+            self.get_upload_session(self.path[17:])  # Remove '/upload/sessions/'
+        elif self.path.startswith('/blobs/'):
+            self.get_blob(self.path[7:])  # Remove '/blobs/'
+        elif self.path == '/admin/bandwidth':
+            self.get_bandwidth()
+        elif self.path == '/archive' or self.path.startswith('/archive?'):
+            self.send_archive(parse_qs(self.path.partition('?')[2]).get('file', []))
         elif self.path.startswith('/download/'):
             filename = unquote(self.path[10:])  # Remove '/download/'
             self.download_file(filename)
@@ -204,6 +2934,21 @@ class FileTransferHandler(BaseHTTPRequestHandler):
     def do_POST(self):
         if self.path == '/upload':
             self.upload_file()
+        elif self.path == '/upload/sessions':
+            self.create_upload_session()
+        elif self.path.startswith('/upload/sessions/') and self.path.endswith('/finalize'):
+            self.finalize_upload_session(self.path[17:-9])  # Remove '/upload/sessions/' and '/finalize'
+        elif self.path == '/archive':
+            self.post_archive()
+        else:
+            self.send_error(404)
+    
+    def do_PUT(self):
+        path, _, query = self.path.partition('?')
+        if path.startswith('/upload/sessions/'):
+            self.put_upload_chunk(path[17:], parse_qs(query))  # Remove '/upload/sessions/'
+        elif path == '/admin/bandwidth':
+            self.set_bandwidth()
         else:
             self.send_error(404)
     
@@ -211,21 +2956,36 @@ class FileTransferHandler(BaseHTTPRequestHandler):
         if self.path.startswith('/delete/'):
             filename = unquote(self.path[8:])  # Remove '/delete/'
             self.delete_file(filename)
+        elif self.path.startswith('/upload/sessions/'):
+            self.abort_upload_session(self.path[17:])  # Remove '/upload/sessions/'
         else:
             self.send_error(404)
     
-    def serve_file(self, filename, content_type):
+    def serve_static(self, asset):
+        """Send an app asset from memory, gzipped if the client takes it, or 304 if it has it"""
         try:
-            with open(filename, 'rb') as f:
-                content = f.read()
-            
+            variants = asset.current()
+        except FileNotFoundError:
+            self.send_error(404)
+            return
+        encoding = 'gzip' if 'gzip' in variants and accepts_gzip(self.headers.get('Accept-Encoding')) else 'identity'
+        content, etag = variants[encoding]
+        if etag_matches(self.headers.get('If-None-Match'), etag):
+            self.send_response(304)
+        else:
             self.send_response(200)
-            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Type', asset.content_type)
             self.send_header('Content-Length', str(len(content)))
-            self.end_headers()
+            if encoding == 'gzip':
+                self.send_header('Content-Encoding', 'gzip')
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        if self.status == 200:
+            # The stored bytes go to the socket as they are, without a copy
             self.wfile.write(content)
-        except FileNotFoundError:
-            self.send_error(404)
+            metrics.inc('bt_sent_bytes_total', amount=len(content))
     
     def upload_file(self):
         try:
@@ -241,285 +3001,689 @@ class FileTransferHandler(BaseHTTPRequestHandler):
                 self.send_error(400, "Bad Request: No content")
                 return
             
-            # Parse form data
-            form = cgi.FieldStorage(
-                fp=self.rfile,
-                headers=self.headers,
-                environ={
-                    'REQUEST_METHOD': 'POST',
-                    'CONTENT_TYPE': self.headers.get('Content-Type'),
-                }
-            )
-            
-            if 'file' not in form:
-                self.send_error(400, "Bad Request: No file field")
+            if content_length > MAX_UPLOAD_SIZE:
+                self.send_error(413, "Payload Too Large: Uploads are limited to 5GB")
                 return
             
-            file_item = form['file']
-            if not file_item.filename:
-                self.send_error(400, "Bad Request: No file selected")
+            boundary = email.parser.HeaderParser().parsestr(f"Content-Type: {content_type}\n").get_param('boundary')
+            if not boundary:
+                self.send_error(400, "Bad Request: Missing multipart boundary")
                 return
             
-            # Save the file
-            filename = file_item.filename
-            # Sanitize filename
-            filename = os.path.basename(filename)
+            # Stream every file part straight into storage as it arrives. A
+            # "ttl" field sets the lifetime of the files that follow it.
+            stored = []
+            ttl = FILE_TTL
+            for part in MultipartParser(self.rfile, boundary, content_length):
+                if part.filename:
+                    stored.append(self.store_upload(part, part.filename, ttl))
+                elif part.name == 'ttl':
+                    ttl = parse_ttl(part.read(32).decode('ascii', 'replace'))
+                    part.drain()
             
-            filepath = os.path.join(self.upload_dir, filename)
+            if not stored:
+                self.send_error(400, "Bad Request: No file selected")
+                return
             
-            # Handle duplicate filenames
-            counter = 1
-            original_filepath = filepath
-            while os.path.exists(filepath):
-                name, ext = os.path.splitext(original_filepath)
-                filepath = f"{name}_{counter}{ext}"
-                counter += 1
+            owner_token = stored[0]['owner_token']
+            self.send_json(200, {"status": "success", "filename": stored[0]['filename'],
+                                 "owner_token": owner_token, "files": stored},
+                           [('X-Owner-Token', owner_token)])  # Return token to client
             
-            # Write file in chunks to handle large files
-            original_size = 0
-            with open(filepath, 'wb') as f:
-                while True:
-                    chunk = file_item.file.read(8192)
-                    if not chunk:
-                        break
-                    original_size += len(chunk)
-                    f.write(chunk)
+        except UploadTooLarge as e:
+            self.send_error(413, f"Payload Too Large: {str(e)}")
+        except UploadError as e:
+            print(f"❌ Upload error: {str(e)}")
+            self.send_error(400, f"Bad Request: {str(e)}")
+        except Exception as e:
+            print(f"❌ Upload error: {str(e)}")
+            self.send_error(500, f"Internal Server Error: {str(e)}")
+    
+    def store_upload(self, source, filename, ttl=FILE_TTL):
+        """Compress, encrypt and store one file read from source. Returns {'filename', 'owner_token', 'expires_at'}"""
+        filename, filepath = self.upload_filepath(filename)
+        
+        # Compress, encrypt and write in a single streaming pass
+        writer = SegmentedWriter(filepath, filename)
+        try:
+            while True:
+                started = time.perf_counter()
+                chunk = source.read(STREAM_READ_SIZE)
+                metrics.observe('bt_upload_stage_seconds', time.perf_counter() - started, ('parse',))
+                if not chunk:
+                    break
+                writer.write(chunk)
+            metadata = writer.close(claim=True)
+        except Exception:
+            writer.abort()
+            raise
+        return self.register_upload(writer.filepath, filename, metadata, ttl)
+    
+    def upload_filepath(self, filename):
+        """Sanitize an uploaded filename. Returns (filename, filepath)
 
-            # Smart compression and encryption
-            with open(filepath, 'rb') as f:
-                file_data = f.read()
-            
-            # Compress if beneficial
-            compressed_data, compressed_size = compress_file_data(file_data, filename)
-            was_compressed = len(compressed_data) < len(file_data)
-            
-            # Create metadata with compression info
-            metadata = {
-                'compressed': was_compressed,
-                'original_size': len(file_data),
-                'filename': filename
-            }
-            metadata_json = json.dumps(metadata).encode()
-            
-            # Combine metadata and data
-            combined_data = len(metadata_json).to_bytes(4, 'big') + metadata_json + compressed_data
-            
-            # Encrypt the combined data
-            encrypted_data = fernet.encrypt(combined_data)
-            
-            # Write encrypted data back
-            with open(filepath, 'wb') as f:
-                f.write(encrypted_data)
+        filepath is where the file would like to go; the name is only claimed
+        once the file is complete, and a taken one becomes name_N.ext then.
+        """
+        # Sanitize filename
+        filename = os.path.basename(filename.replace('\\', '/'))
+        if not filename or not is_stored_file(filename):
+            raise UploadError("Invalid filename")
+        return filename, os.path.join(self.upload_dir, filename)
+    
+    def register_upload(self, filepath, filename, metadata, ttl=FILE_TTL):
+        """Issue the owner token, record a freshly stored file and schedule its deletion"""
+        original_size = metadata['original_size']
+        compressed_size = metadata['stored_size']
 
-            # Generate unique owner token for this upload
-            owner_token = generate_token()
-            token_path = f"{filepath}.token"
-            with open(token_path, 'w') as token_file:
-                token_file.write(owner_token)
-            
-            # Log to analytics
-            file_type = os.path.splitext(filename)[1].lower() or 'unknown'
-            client_ip = self.client_address[0]
-            analytics.log_upload(filename, original_size, file_type, client_ip, compressed_size)
-            
+        # Generate unique owner token for this upload
+        owner_token = generate_token()
+        token_path = f"{filepath}.token"
+        with open(token_path, 'w') as token_file:
+            token_file.write(owner_token)
+        deduplicated = bool(metadata.get('sha256')) and share_blob(filepath, metadata['sha256'])
+        uploaded_at = time.time()
+        if original_size:
+            metrics.observe('bt_compression_ratio', compressed_size / original_size)
+        catalog.add(filepath, metadata, owner_token=owner_token, uploaded_at=uploaded_at, ttl=ttl)
+        expiry.schedule(os.path.basename(filepath), uploaded_at + ttl)
+        
+        # Log to analytics
+        file_type = os.path.splitext(filename)[1].lower() or 'unknown'
+        client_ip = self.client_address[0]
+        analytics.log_upload(filename, original_size, file_type, client_ip, compressed_size)
+        
+        if deduplicated:
+            print(f"✅ File uploaded: {os.path.basename(filepath)} ({self.get_file_size(filepath)}, deduplicated)")
+        else:
             print(f"✅ File uploaded: {os.path.basename(filepath)} ({self.get_file_size(filepath)})")
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('X-Owner-Token', owner_token)  # Return token to client
-            self.end_headers()
-            response = json.dumps({"status": "success", "filename": os.path.basename(filepath), "owner_token": owner_token})
-            self.wfile.write(response.encode())
-            
+        return {"filename": os.path.basename(filepath), "owner_token": owner_token,
+                "expires_at": int(uploaded_at + ttl)}
+    
+    def read_json_body(self, limit=MAX_FIELD_SIZE):
+        content_length = int(self.headers.get('Content-Length', 0))
+        if content_length > limit:
+            raise UploadError("Request body too large")
+        try:
+            return json.loads(self.rfile.read(content_length) or b'{}')
+        except ValueError:
+            raise UploadError("Request body must be JSON")
+    
+    def send_json(self, status, payload, extra_headers=()):
+        response = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        for name, value in extra_headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(response)
+        metrics.inc('bt_sent_bytes_total', amount=len(response))
+    
+    def send_stream(self, status, content_type, chunks, extra_headers=(), flush=False):
+        """Send a body whose length is not known up front.
+
+        HTTP/1.1 clients get chunked transfer encoding and keep the
+        connection; HTTP/1.0 clients read until the connection closes. A
+        failure mid-body leaves the body unterminated so the client sees it.
+        With flush, every chunk is pushed out as soon as it is written.
+        """
+        chunked = self.request_version != 'HTTP/1.0'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        for name, value in extra_headers:
+            self.send_header(name, value)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        try:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                if chunked:
+                    self.wfile.write(f'{len(chunk):x}\r\n'.encode())
+                    self.write_body(chunk)
+                    self.wfile.write(b'\r\n')
+                else:
+                    self.write_body(chunk)
+                if flush:
+                    self.wfile.flush()
+        except Exception:
+            self.close_connection = True
+            raise
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+    
+    def create_upload_session(self):
+        """POST /upload/sessions {"filename", "size", "sha256"?} -> session status
+
+        When the declared sha256 is already stored the file is linked to it
+        straight away and the response is the finalize response instead.
+        """
+        try:
+            body = self.read_json_body()
+            filename = body.get('filename')
+            if not isinstance(filename, str) or not filename:
+                raise UploadError("filename is required")
+            filename = os.path.basename(filename.replace('\\', '/'))
+            if not is_stored_file(filename):
+                raise UploadError("Invalid filename")
+            ttl = parse_ttl(body['ttl']) if body.get('ttl') is not None else FILE_TTL
+            session = UploadSession.create(filename, body.get('size'), body.get('sha256'), ttl)
+            if session.info['sha256'] and self.link_existing_blob(session):
+                return
+            self.send_json(201, session.status())
+        except UploadTooLarge as e:
+            self.send_error(413, f"Payload Too Large: {str(e)}")
+        except UploadError as e:
+            self.send_error(400, f"Bad Request: {str(e)}")
         except Exception as e:
-            print(f"❌ Upload error: {str(e)}")
+            print(f"❌ Upload session error: {str(e)}")
+            self.send_error(500, f"Internal Server Error: {str(e)}")
+    
+    def link_existing_blob(self, session):
+        """Finish a session from an already stored blob. Returns False if there is none"""
+        try:
+            metadata = read_file_metadata(blob_path(session.info['sha256']))
+        except Exception:
+            return False
+        if metadata.get('original_size') != session.size or metadata.get('sha256') != session.info['sha256']:
+            return False
+        filename, filepath = self.upload_filepath(session.info['filename'])
+        filepath = link_blob(session.info['sha256'], filepath)
+        if filepath is None:
+            return False
+        session.delete()
+        metadata['filename'] = session.info['filename']
+        stored = self.register_upload(filepath, filename, metadata, session.info.get('ttl', FILE_TTL))
+        self.send_json(200, {"status": "success", "filename": stored['filename'],
+                             "owner_token": stored['owner_token'], "files": [stored], "deduplicated": True},
+                       [('X-Owner-Token', stored['owner_token'])])
+        return True
+    
+    def get_blob(self, content_hash):
+        """GET /blobs/<sha256> -> whether content with this hash is already stored"""
+        try:
+            exists = os.path.isfile(blob_path(content_hash))
+        except ValueError:
+            self.send_error(400, "Bad Request: Invalid sha256")
+            return
+        self.send_json(200, {"sha256": content_hash, "exists": exists})
+    
+    def get_upload_session(self, session_id):
+        """GET /upload/sessions/<id> -> which byte ranges the server already has"""
+        session = UploadSession.load(session_id)
+        if not session:
+            self.send_error(404, "Upload session not found")
+            return
+        self.send_json(200, session.status())
+    
+    def put_upload_chunk(self, session_id, query):
+        """PUT /upload/sessions/<id>?offset=N with the chunk starting at byte N as the body"""
+        session = UploadSession.load(session_id)
+        if not session:
+            self.send_error(404, "Upload session not found")
+            return
+        try:
+            offset = int(query.get('offset', ['0'])[0])
+            if offset < 0 or offset % session.chunk_size:
+                raise UploadError(f"offset must be a multiple of {session.chunk_size}")
+            length = int(self.headers.get('Content-Length', -1))
+            session.write_chunk(offset // session.chunk_size, self.rfile, length)
+            self.send_json(200, {'status': 'success', 'offset': offset, 'length': length})
+        except (UploadError, ValueError) as e:
+            # The body may be partly unread, so this connection cannot be reused
+            self.close_connection = True
+            self.send_error(400, f"Bad Request: {str(e)}")
+        except Exception as e:
+            print(f"❌ Upload chunk error: {str(e)}")
+            self.close_connection = True
             self.send_error(500, f"Internal Server Error: {str(e)}")
     
+    def finalize_upload_session(self, session_id):
+        """POST /upload/sessions/<id>/finalize -> store the file, same response as /upload"""
+        session = UploadSession.load(session_id)
+        if not session:
+            self.send_error(404, "Upload session not found")
+            return
+        try:
+            filename, filepath = self.upload_filepath(session.info['filename'])
+            metadata, filepath = session.finalize(filepath)
+            stored = self.register_upload(filepath, filename, metadata, session.info.get('ttl', FILE_TTL))
+            self.send_json(200, {"status": "success", "filename": stored['filename'],
+                                 "owner_token": stored['owner_token'], "files": [stored]},
+                           [('X-Owner-Token', stored['owner_token'])])
+        except UploadError as e:
+            self.send_error(409, f"Conflict: {str(e)}")
+        except Exception as e:
+            print(f"❌ Upload finalize error: {str(e)}")
+            self.send_error(500, f"Internal Server Error: {str(e)}")
+    
+    def abort_upload_session(self, session_id):
+        session = UploadSession.load(session_id)
+        if not session:
+            self.send_error(404, "Upload session not found")
+            return
+        session.delete()
+        self.send_json(200, {"status": "success", "message": "Upload session cancelled"})
+    
     def list_files(self):
         try:
-            files = []
-            for filename in os.listdir(self.upload_dir):
-                filepath = os.path.join(self.upload_dir, filename)
-                # Skip system files, hidden files, and token files
-                if (os.path.isfile(filepath) and 
-                    not filename.endswith('.token') and 
-                    not filename.startswith('.') and 
-                    filename not in ['.gitkeep', '.DS_Store', 'Thumbs.db']):
-                    
-                    # Read metadata to get original size
-                    original_size = os.path.getsize(filepath) # Fallback to current size
-                    try:
-                        with open(filepath, 'rb') as f:
-                            encrypted_data = f.read()
-                            decrypted_data = fernet.decrypt(encrypted_data)
-                            
-                            # Extract metadata size
-                            metadata_len = int.from_bytes(decrypted_data[:4], 'big')
-                            # Extract metadata JSON
-                            metadata_json = decrypted_data[4:4+metadata_len]
-                            metadata = json.loads(metadata_json.decode())
-                            original_size = metadata.get('original_size', original_size)
-
-                    except Exception as e:
-                        print(f"Could not read metadata for {filename}: {e}")
-
-                    files.append({
-                        'name': filename,
-                        'size': original_size
-                    })
+            files = catalog.list_files()
+            self.send_json(200, files, [('Access-Control-Allow-Origin', '*')])
             
-            files.sort(key=lambda f: os.path.getmtime(os.path.join(self.upload_dir, f['name'])), reverse=True)
+        except Exception as e:
+            print(f"❌ List files error: {str(e)}")
+            self.send_error(500)
+    
+    def list_files_page(self, query):
+        """GET /files?sort=&order=&limit=&cursor=&type=&min_size=&max_size=&min_age=&max_age=&owner=mine
+
+        owner=mine keeps the files whose owner tokens are listed, comma
+        separated, in X-Owner-Token. The response carries next_cursor (null on
+        the last page) and changes, the change feed position to follow from.
+        """
+        try:
+            def number(name, default=None):
+                value = query.get(name, [None])[0]
+                if value is None:
+                    return default
+                if not value.isdigit():
+                    raise ValueError(f"{name} must be a whole number")
+                return int(value)
             
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
+            sort = query.get('sort', ['uploaded'])[0]
+            if sort not in LIST_SORTS:
+                raise ValueError(f"sort must be one of {', '.join(LIST_SORTS)}")
+            order = query.get('order', ['asc' if sort in ('name', 'expires') else 'desc'])[0]
+            if order not in ('asc', 'desc'):
+                raise ValueError("order must be asc or desc")
+            limit = number('limit', DEFAULT_PAGE_SIZE)
+            if not 1 <= limit <= MAX_PAGE_SIZE:
+                raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
             
-            response = json.dumps(files)
-            self.wfile.write(response.encode())
+            after = None
+            if 'cursor' in query:
+                try:
+                    cursor_sort, cursor_order, value, name = json.loads(base64.urlsafe_b64decode(query['cursor'][0]))
+                except (ValueError, TypeError):
+                    raise ValueError("Invalid cursor")
+                if (cursor_sort, cursor_order) != (sort, order):
+                    raise ValueError("cursor belongs to a different sort order")
+                if (not isinstance(value, (str, int, float)) or isinstance(value, bool)
+                        or not isinstance(name, str)):
+                    raise ValueError("Invalid cursor")
+                after = (value, name)
             
+            extensions = [extension.strip().lstrip('.').lower()
+                          for value in query.get('type', []) for extension in value.split(',') if extension.strip()]
+            if not all(extension.isalnum() for extension in extensions):
+                raise ValueError("type must be file extensions")
+            min_size, max_size = number('min_size'), number('max_size')
+            now = time.time()
+            max_age, min_age = number('max_age'), number('min_age')
+            owner_hashes = None
+            if 'owner' in query:
+                if query['owner'][0] != 'mine':
+                    raise ValueError("owner must be mine")
+                tokens = self.headers.get('X-Owner-Token', '')
+                owner_hashes = [hash_token(token.strip()) for token in tokens.split(',') if token.strip()]
+        except ValueError as e:
+            self.send_error(400, f"Bad Request: {str(e)}")
+            return
+        
+        try:
+            # Read the feed position first: changes racing the query are replayed, never lost
+            changes = catalog.latest_change()
+            files, next_after = catalog.list_page(
+                sort, order == 'desc', after, limit, extensions, min_size, max_size,
+                None if max_age is None else now - max_age, None if min_age is None else now - min_age,
+                owner_hashes)
+            next_cursor = None
+            if next_after:
+                next_cursor = base64.urlsafe_b64encode(json.dumps([sort, order, *next_after]).encode()).decode()
+            self.send_json(200, {"files": files, "next_cursor": next_cursor, "changes": changes},
+                           [('Access-Control-Allow-Origin', '*'), ('Cache-Control', 'no-store')])
         except Exception as e:
             print(f"❌ List files error: {str(e)}")
             self.send_error(500)
     
+    def watch_files(self, query):
+        """GET /files/changes?after=<id>: file changes after a change feed position.
+
+        EventSource clients (Accept: text/event-stream) get a stream of add,
+        delete and expire events for up to CHANGE_STREAM_SECONDS, resumed
+        from Last-Event-ID when they reconnect; anyone else gets a long poll
+        that answers {"changes", "cursor", "reset"} as soon as there is a
+        change, or empty after ?wait= seconds. reset asks the client to load
+        the listing again because the changes it missed are gone.
+        """
+        try:
+            after = self.headers.get('Last-Event-ID') or query.get('after', [None])[0]
+            if after is None:
+                after = catalog.latest_change()
+            elif not after.isdigit():
+                raise ValueError("after must be a change id")
+            wait = float(query.get('wait', [CHANGE_WAIT])[0])
+            if not 0 <= wait <= CHANGE_WAIT:
+                raise ValueError(f"wait must be between 0 and {CHANGE_WAIT} seconds")
+        except ValueError as e:
+            self.send_error(400, f"Bad Request: {str(e)}")
+            return
+        
+        if 'text/event-stream' in self.headers.get('Accept', ''):
+            try:
+                self.send_stream(200, 'text/event-stream', self.iter_change_events(int(after)),
+                                 [('Cache-Control', 'no-store')], flush=True)
+            except (ConnectionError, TimeoutError):
+                pass  # The client went away
+            except Exception as e:
+                print(f"❌ Change feed error: {str(e)}")
+            return
+        
+        try:
+            changes, reset = catalog.wait_for_changes(int(after), wait)
+            cursor = changes[-1]['id'] if changes else int(after)
+            self.send_json(200, {"changes": changes, "cursor": cursor, "reset": reset},
+                           [('Access-Control-Allow-Origin', '*'), ('Cache-Control', 'no-store')])
+        except Exception as e:
+            print(f"❌ Change feed error: {str(e)}")
+            self.send_error(500)
+    
+    def iter_change_events(self, after):
+        yield f'retry: {CHANGE_RETRY_MS}\n\n'.encode()
+        deadline = time.monotonic() + CHANGE_STREAM_SECONDS
+        while time.monotonic() < deadline:
+            changes, reset = catalog.wait_for_changes(after, min(CHANGE_HEARTBEAT, deadline - time.monotonic()))
+            if reset:
+                yield b'event: reset\ndata: {}\n\n'
+                return
+            if not changes:
+                yield b': keep-alive\n\n'  # Finds clients that have gone away
+            for change in changes:
+                yield f"id: {change['id']}\nevent: {change['type']}\ndata: {json.dumps(change)}\n\n".encode()
+                after = change['id']
+    
+    def stored_file(self, filename):
+        """(filepath, catalog entry) of a stored file named in a URL, or (None, None) if the catalog does not list it.
+
+        Only catalog names are served, so no name can reach tokens, the
+        database or anything outside the upload directory.
+        """
+        entry = catalog.get(filename) if os.path.basename(filename) == filename and is_stored_file(filename) else None
+        filepath = os.path.join(self.upload_dir, filename)
+        if entry is None or not os.path.isfile(filepath):
+            return None, None
+        return filepath, entry
+    
     def download_file(self, filename):
         try:
-            filepath = os.path.join(self.upload_dir, filename)
-            if not os.path.exists(filepath) or not os.path.isfile(filepath):
+            filepath, entry = self.stored_file(filename)
+            if filepath is None:
                 self.send_error(404, "File not found")
                 return
+            validators = self.file_validators(entry)
+            if self.send_not_modified(validators):
+                return
             
-            # First decrypt and extract data with metadata
-            with open(filepath, 'rb') as f:
-                encrypted_data = f.read()
-                try:
-                    # Decrypt first
-                    decrypted_data = fernet.decrypt(encrypted_data)
-                    
-                    # Check if this is new format with metadata
-                    try:
-                        # Extract metadata length (first 4 bytes)
-                        metadata_len = int.from_bytes(decrypted_data[:4], 'big')
-                        # Extract metadata JSON
-                        metadata_json = decrypted_data[4:4+metadata_len]
-                        metadata = json.loads(metadata_json.decode())
-                        # Extract file data
-                        file_data = decrypted_data[4+metadata_len:]
-                        
-                        # Decompress only if it was compressed
-                        if metadata.get('compressed', False):
-                            final_data = gzip.decompress(file_data)
-                        else:
-                            final_data = file_data
-                            
-                    except (json.JSONDecodeError, ValueError, struct.error):
-                        # Fallback to old format
-                        final_data = decompress_file_data(decrypted_data, filename)
-                    
-                    # Update download counter
-                    analytics.increment_download(filename)
-                    
-                    # Send correct headers with actual file size
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'application/octet-stream')
-                    self.send_header('Content-Disposition', f'attachment; filename="{filename}"')
-                    self.send_header('Content-Length', str(len(final_data)))
-                    self.end_headers()
-                    
-                    # Send decompressed data in chunks
-                    offset = 0
-                    while offset < len(final_data):
-                        chunk_size = min(8192, len(final_data) - offset)
-                        chunk = final_data[offset:offset + chunk_size]
-                        self.wfile.write(chunk)
-                        offset += chunk_size
-                        
-                except Exception as e:
-                    print(f"Decryption/decompression error: {e}")
-                    # Fallback: send encrypted data as-is
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'application/octet-stream')
-                    self.send_header('Content-Disposition', f'attachment; filename="{filename}"')
-                    self.send_header('Content-Length', str(len(encrypted_data)))
-                    self.end_headers()
-                    self.wfile.write(encrypted_data)
+            try:
+                original_size, read_range = open_stored_ranges(filepath, filename)
+            except Exception as e:
+                print(f"Decryption/decompression error: {e}")
+                self.send_error(500, "Failed to process file")
+                return
+
+            ranges = parse_range_header(self.headers.get('Range'), original_size)
+            gzip_stream = open_gzip_stream(filepath) if is_deflate_stored(entry) else None
+            status = self.send_ranges(original_size, read_range, ranges, 'application/octet-stream',
+                                      [('Content-Disposition', f'attachment; filename="{filename}"')],
+                                      gzip_stream, validators)
+
+            # Count downloads once, not per resumed or seeking range request or revalidation
+            if status == 200 or (status == 206 and ranges[0][0] == 0):
+                analytics.increment_download(filename)
             
             print(f"📥 File downloaded: {filename}")
             
         except Exception as e:
             print(f"❌ Download error: {str(e)}")
-            self.send_error(500)
+            self.send_failure()
     
     def preview_file(self, filename):
         """Serve file for preview/streaming with proper MIME type detection"""
         try:
-            filepath = os.path.join(self.upload_dir, filename)
-            if not os.path.exists(filepath) or not os.path.isfile(filepath):
+            filepath, entry = self.stored_file(filename)
+            if filepath is None:
                 self.send_error(404, "File not found")
                 return
+            validators = self.file_validators(entry)
+            if self.send_not_modified(validators):
+                return
             
-            # Decrypt and extract data with metadata
-            with open(filepath, 'rb') as f:
-                encrypted_data = f.read()
-                try:
-                    # Decrypt first
-                    decrypted_data = fernet.decrypt(encrypted_data)
-                    
-                    # Check if this is new format with metadata
-                    try:
-                        # Extract metadata length (first 4 bytes)
-                        metadata_len = int.from_bytes(decrypted_data[:4], 'big')
-                        # Extract metadata JSON
-                        metadata_json = decrypted_data[4:4+metadata_len]
-                        metadata = json.loads(metadata_json.decode())
-                        # Extract file data
-                        file_data = decrypted_data[4+metadata_len:]
-                        
-                        # Decompress only if it was compressed
-                        if metadata.get('compressed', False):
-                            final_data = gzip.decompress(file_data)
-                        else:
-                            final_data = file_data
-                            
-                    except (json.JSONDecodeError, ValueError, struct.error):
-                        # Fallback to old format
-                        final_data = decompress_file_data(decrypted_data, filename)
-                        
-                except Exception as e:
-                    print(f"Decryption/decompression error for preview: {e}")
-                    self.send_error(500, "Failed to process file")
-                    return
+            try:
+                original_size, read_range = open_stored_ranges(filepath, filename)
+            except Exception as e:
+                print(f"Decryption/decompression error for preview: {e}")
+                self.send_error(500, "Failed to process file")
+                return
             
             # Detect MIME type based on file extension
             content_type, _ = mimetypes.guess_type(filename)
             if content_type is None:
                 content_type = 'application/octet-stream'
             
-            # Set appropriate headers for preview/streaming
-            self.send_response(200)
-            self.send_header('Content-Type', content_type)
-            self.send_header('Content-Length', str(len(final_data)))
-            
-            # Add headers for better media handling
-            if content_type.startswith(('audio/', 'video/')):
-                self.send_header('Accept-Ranges', 'bytes')
-                self.send_header('Cache-Control', 'no-cache')
-            
-            self.end_headers()
-            
-            # Send the file data
-            self.wfile.write(final_data)
+            ranges = parse_range_header(self.headers.get('Range'), original_size)
+            gzip_stream = open_gzip_stream(filepath) if is_deflate_stored(entry) else None
+            self.send_ranges(original_size, read_range, ranges, content_type, [], gzip_stream, validators)
             
             print(f"👁️ File previewed: {filename}")
             
         except Exception as e:
             print(f"❌ Preview error: {str(e)}")
-            self.send_error(500)
+            self.send_failure()
     
-    def delete_file(self, filename):
+    def file_validators(self, entry):
+        """(etag, last_modified, varies) of a stored file from its catalog entry.
+
+        The entity tag is the content hash recorded at upload, so it costs
+        nothing per request; files stored before hashing only have a date.
+        varies is whether the file has a gzip form, so responses depend on
+        Accept-Encoding.
+        """
+        etag = f'"{entry["content_hash"]}"' if entry['content_hash'] else None
+        return etag, entry['uploaded_at'], is_deflate_stored(entry)
+    
+    def validator_headers(self, etag, last_modified, varies):
+        headers = [('Cache-Control', 'private, no-cache')]
+        if varies:
+            headers.append(('Vary', 'Accept-Encoding'))
+        if etag:
+            headers.append(('ETag', etag))
+        if last_modified is not None:
+            headers.append(('Last-Modified', self.date_time_string(last_modified)))
+        return headers
+    
+    def send_not_modified(self, validators):
+        """Answer 304 if the client's copy is current. Returns True if it did.
+
+        Runs on catalog data alone, before the stored file is opened. A
+        client that accepts gzip may hold the gzip form, which has its own tag.
+        """
+        etag, last_modified, varies = validators
+        tags = [etag]
+        if etag and varies and accepts_gzip(self.headers.get('Accept-Encoding')):
+            tags.append(f'{etag[:-1]}-gzip"')
+        for tag in tags:
+            if is_not_modified(self.headers, tag, last_modified):
+                self.send_response(304)
+                for name, value in self.validator_headers(tag, last_modified, varies):
+                    self.send_header(name, value)
+                self.end_headers()
+                return True
+        return False
+    
+    def send_ranges(self, size, read_range, ranges, content_type, extra_headers, gzip_stream=None,
+                    validators=(None, None, False)):
+        """Send a whole file (200), one range (206), several ranges (206 multipart) or 416.
+        Returns the status sent.
+
+        gzip_stream is the file's stored gzip form, if it has one, as returned
+        by open_gzip_stream. Whole-file responses go out in that form to
+        clients that accept gzip, without decompressing on the server. Ranges
+        always refer to the uncompressed bytes, so range requests get them
+        decompressed.
+
+        validators is the file's (etag, last_modified, varies), from
+        file_validators. The gzip form has its own entity tag. Callers answer
+        304 with send_not_modified before the file is opened; here a range
+        whose If-Range no longer matches gets the whole file instead.
+        """
+        etag, last_modified, varies = validators
+        if ranges is not None and not if_range_allows(self.headers.get('If-Range'), etag, last_modified):
+            ranges = None
+        use_gzip = gzip_stream is not None and ranges is None and accepts_gzip(self.headers.get('Accept-Encoding'))
+        if use_gzip and etag:
+            etag = f'{etag[:-1]}-gzip"'
+
+        if gzip_stream is not None and not use_gzip:
+            gzip_stream[1].close()
+        extra_headers = list(extra_headers) + self.validator_headers(etag, last_modified, varies)
+
+        if use_gzip:
+            length, chunks = gzip_stream
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(length))
+            self.send_header('Accept-Ranges', 'bytes')
+            for name, value in extra_headers:
+                self.send_header(name, value)
+            self.end_headers()
+            for chunk in chunks:
+                self.write_body(chunk)
+            return 200
+
+        if ranges is not None and not ranges:
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return 416
+
+        if ranges is None:
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(size))
+            self.send_header('Accept-Ranges', 'bytes')
+            for name, value in extra_headers:
+                self.send_header(name, value)
+            self.end_headers()
+            for chunk in read_range(0, size):
+                self.write_body(chunk)
+            return 200
+
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            self.send_response(206)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Range', f'bytes {start}-{end - 1}/{size}')
+            self.send_header('Content-Length', str(end - start))
+            self.send_header('Accept-Ranges', 'bytes')
+            for name, value in extra_headers:
+                self.send_header(name, value)
+            self.end_headers()
+            for chunk in read_range(start, end):
+                self.write_body(chunk)
+            return 206
+
+        boundary = uuid.uuid4().hex
+        part_headers = [
+            (f'--{boundary}\r\nContent-Type: {content_type}\r\n'
+             f'Content-Range: bytes {start}-{end - 1}/{size}\r\n\r\n').encode()
+            for start, end in ranges
+        ]
+        closing = f'--{boundary}--\r\n'.encode()
+        length = sum(len(h) + (end - start) + 2 for h, (start, end) in zip(part_headers, ranges)) + len(closing)
+
+        self.send_response(206)
+        self.send_header('Content-Type', f'multipart/byteranges; boundary={boundary}')
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        for name, value in extra_headers:
+            self.send_header(name, value)
+        self.end_headers()
+        for part_header, (start, end) in zip(part_headers, ranges):
+            self.wfile.write(part_header)
+            for chunk in read_range(start, end):
+                self.write_body(chunk)
+            self.wfile.write(b'\r\n')
+        self.wfile.write(closing)
+        return 206
+
+    def post_archive(self):
+        """POST /archive {"files": [names]}, or a form with a names field per file -> the files as one ZIP"""
+        # Room for a full archive's worth of long names
+        limit = MAX_ARCHIVE_FILES * 1024
         try:
+            if self.headers.get('Content-Type', '').split(';')[0].strip() == 'application/x-www-form-urlencoded':
+                content_length = int(self.headers.get('Content-Length', 0))
+                if content_length > limit:
+                    raise UploadError("Request body too large")
+                files = parse_qs(self.rfile.read(content_length).decode('utf-8', 'replace')).get('names', [])
+            else:
+                files = self.read_json_body(limit=limit).get('files')
+            if not isinstance(files, list) or not all(isinstance(name, str) for name in files):
+                raise UploadError("files must be a list of file names")
+        except (UploadError, AttributeError) as e:
+            self.send_error(400, f"Bad Request: {str(e)}")
+            return
+        self.send_archive(files)
+    
+    def send_archive(self, filenames):
+        """Stream the named stored files as a ZIP archive"""
+        filenames = list(dict.fromkeys(filenames))
+        if not filenames:
+            self.send_error(400, "Bad Request: No files named")
+            return
+        if len(filenames) > MAX_ARCHIVE_FILES:
+            self.send_error(400, f"Bad Request: At most {MAX_ARCHIVE_FILES} files per archive")
+            return
+        
+        members, missing = [], []
+        for filename in filenames:
             filepath = os.path.join(self.upload_dir, filename)
-            if not os.path.exists(filepath) or not os.path.isfile(filepath):
+            # Only names in the catalog are served, so no path can leave the upload directory
+            entry = catalog.get(filename)
+            if entry is None or not os.path.isfile(filepath):
+                missing.append(filename)
+                continue
+            deflate = bool(entry['compressed']) and os.path.splitext(filename)[1].lower() not in COMPRESSED_FORMATS
+            members.append((filename, entry['original_size'], entry['uploaded_at'] or entry['mtime'] or 0, deflate,
+                            lambda filepath=filepath, filename=filename: self.iter_archive_member(filepath, filename)))
+        if missing:
+            self.send_json(404, {"status": "error", "message": "Files not found", "missing": missing})
+            return
+        
+        archive_name = f"b-transfer-{datetime.now():%Y%m%d-%H%M%S}.zip"
+        try:
+            self.send_stream(200, 'application/zip', iter_zip(members),
+                             [('Content-Disposition', f'attachment; filename="{archive_name}"')])
+            print(f"📦 Archive downloaded: {len(members)} files")
+        except Exception as e:
+            # The headers are gone already; the unterminated body tells the client
+            print(f"❌ Archive error: {str(e)}")
+    
+    def iter_archive_member(self, filepath, filename):
+        original_size, read_range = open_stored_ranges(filepath, filename)
+        yield from read_range(0, original_size)
+        analytics.increment_download(filename)
+    
+    def delete_file(self, filename):
+        try:
+            filepath, _entry = self.stored_file(filename)
+            if filepath is None:
                 self.send_error(404, "File not found")
                 return
             
@@ -541,15 +3705,10 @@ class FileTransferHandler(BaseHTTPRequestHandler):
                 self.send_error(403, "Forbidden: Invalid owner token")
                 return
 
-            os.remove(filepath)
-            os.remove(token_path)  # Remove the token file linked to the file
+            remove_stored_file(filename, self.upload_dir)
             print(f"🗑️ File manually deleted: {filename}")
             
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            response = json.dumps({"status": "success", "message": "File deleted successfully"})
-            self.wfile.write(response.encode())
+            self.send_json(200, {"status": "success", "message": "File deleted successfully"})
             
         except Exception as e:
             print(f"❌ Delete error: {str(e)}")
@@ -559,19 +3718,21 @@ class FileTransferHandler(BaseHTTPRequestHandler):
         """Return analytics data as JSON"""
         try:
             stats = analytics.get_stats()
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            
-            response = json.dumps(stats)
-            self.wfile.write(response.encode())
+            self.send_json(200, stats, [('Access-Control-Allow-Origin', '*')])
             
         except Exception as e:
             print(f"❌ Analytics error: {str(e)}")
             self.send_error(500)
     
+    def get_metrics(self):
+        """Prometheus text exposition of this process's metrics"""
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
     def health_check(self):
         """Health check endpoint for monitoring"""
         try:
@@ -594,21 +3755,45 @@ class FileTransferHandler(BaseHTTPRequestHandler):
                     'uploads_directory': uploads_ok,
                     'database': db_ok,
                     'encryption': True  # Fernet is always available if server starts
-                }
+                },
+                'lanes': scheduler.stats(),
+                'segment_cache': segment_cache.stats()
             }
             
-            self.send_response(200 if health_status['status'] == 'healthy' else 503)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            
-            response = json.dumps(health_status, indent=2)
-            self.wfile.write(response.encode())
+            self.send_json(200 if health_status['status'] == 'healthy' else 503, health_status,
+                           [('Access-Control-Allow-Origin', '*')])
             
         except Exception as e:
             print(f"❌ Health check error: {str(e)}")
             self.send_error(500)
     
+    def is_admin(self):
+        """Check X-Admin-Token; admin routes do not exist unless $BT_ADMIN_TOKEN is set"""
+        if not ADMIN_TOKEN:
+            self.send_error(404)
+            return False
+        if not secrets.compare_digest(self.headers.get('X-Admin-Token', '').encode(), ADMIN_TOKEN.encode()):
+            self.send_error(403, "Forbidden: Invalid admin token")
+            return False
+        return True
+    
+    def get_bandwidth(self):
+        """GET /admin/bandwidth -> limits and who is being throttled"""
+        if self.is_admin():
+            self.send_json(200, shaper.stats())
+    
+    def set_bandwidth(self):
+        """PUT /admin/bandwidth {"download": {"client": "10M"}, ...} -> new limits, applied at once"""
+        if not self.is_admin():
+            return
+        try:
+            shaper.set_limits(self.read_json_body())
+        except (UploadError, ValueError, AttributeError) as e:
+            self.send_error(400, f"Bad Request: {str(e)}")
+            return
+        print(f"🚦 Bandwidth limits changed: {shaper.limits}")
+        self.send_json(200, shaper.stats())
+    
     def get_file_size(self, filepath):
         size_bytes = os.path.getsize(filepath)
         if size_bytes == 0:
@@ -620,6 +3805,211 @@ class FileTransferHandler(BaseHTTPRequestHandler):
             i += 1
         return f"{size_bytes:.1f} {size_names[i]}"
 
+# asyncio engine
+#
+# Connections, request heads and socket I/O live on one event loop, so idle and
+# slow connections cost a coroutine rather than an OS thread. Each parsed
+# request is run by the ordinary FileTransferHandler route methods on a bounded
+# thread pool, which also keeps compression, encryption and disk I/O off the
+# loop. The handler's rfile/wfile are bridged back to the loop's streams.
+MAX_REQUEST_HEAD = 64 * 1024
+
+class AsyncBodyReader:
+    """File-like rfile for handler threads, reading from an asyncio StreamReader.
+
+    Like the socket timeout of the threaded engine, a read that stalls for
+    REQUEST_TIMEOUT raises TimeoutError.
+    """
+
+    def __init__(self, reader, loop):
+        self.reader = reader
+        self.loop = loop
+
+    async def _readexactly(self, size):
+        try:
+            return await self.reader.readexactly(size)
+        except asyncio.IncompleteReadError as e:
+            return e.partial
+
+    def _wait(self, coroutine):
+        try:
+            return asyncio.run_coroutine_threadsafe(asyncio.wait_for(coroutine, REQUEST_TIMEOUT), self.loop).result()
+        except TimeoutError:
+            raise TimeoutError("timed out") from None
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self._wait(self.reader.read())
+        return self._wait(self._readexactly(size))
+
+    def readline(self, limit=-1):
+        return self._wait(self.reader.readline())
+
+class AsyncResponseWriter:
+    """File-like wfile for handler threads, writing to an asyncio StreamWriter.
+
+    Small writes (status line, headers, JSON bodies) are collected and handed to
+    the loop in one go; large ones are sent with flow control so a slow client
+    holds back its own handler thread and nothing else.
+    """
+
+    def __init__(self, writer, loop):
+        self.writer = writer
+        self.loop = loop
+        self.buffer = bytearray()
+        self.bytes_written = 0
+
+    async def _send(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        if len(data) >= STREAM_READ_SIZE:
+            # Large bodies are handed over as they are rather than copied into the buffer
+            self.flush()
+            asyncio.run_coroutine_threadsafe(self._send(data), self.loop).result()
+            return len(data)
+        self.buffer += data
+        if len(self.buffer) >= STREAM_READ_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            data = bytes(self.buffer)
+            self.buffer.clear()
+            asyncio.run_coroutine_threadsafe(self._send(data), self.loop).result()
+
+    def finish(self):
+        """Hand the rest of the response to the loop without waiting for it to be sent"""
+        if self.buffer:
+            data = bytes(self.buffer)
+            self.buffer.clear()
+            self.loop.call_soon_threadsafe(self.writer.write, data)
+
+class AsyncHTTPServer:
+    """Serve a BaseHTTPRequestHandler subclass from an asyncio event loop"""
+
+    def __init__(self, server_address, RequestHandlerClass, workers=32, reuse_port=False):
+        self.server_address = server_address
+        self.RequestHandlerClass = RequestHandlerClass
+        self.reuse_port = reuse_port
+        self.connections = 0
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bt-worker')
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        host, port = self.server_address
+        server = await asyncio.start_server(self._handle_connection, host, port,
+                                            limit=MAX_REQUEST_HEAD, backlog=1024,
+                                            reuse_port=self.reuse_port or None)
+        async with server:
+            await server.serve_forever()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _handle_connection(self, reader, writer):
+        """Serve requests from one connection until it closes, idles out or hits the request cap"""
+        loop = asyncio.get_running_loop()
+        if self.connections >= MAX_CONNECTIONS:
+            writer.write(BUSY_RESPONSE)
+            writer.close()
+            return
+        self.connections += 1
+        requests_served = 0
+        connection_buckets = shaper.connection_buckets()
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), KEEPALIVE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, TimeoutError):
+                    break
+                handler = self._make_handler(head, reader, writer, loop, requests_served, connection_buckets)
+                if handler is None:
+                    break
+                requests_served = handler.requests_served
+                lane, client = request_lane(handler.command, handler.path), handler.client
+                try:
+                    await scheduler.admit_async(lane, client)
+                except Overloaded as e:
+                    handler.send_overloaded(e)
+                    handler.record_request()
+                    self._write_buffered(handler, writer)
+                    # Reading the rest of the body would block the loop
+                    if handler.close_connection or handler.rfile.remaining:
+                        break
+                    continue
+                try:
+                    await loop.run_in_executor(self.executor, self._run_handler, handler)
+                finally:
+                    scheduler.release(lane, client)
+                await writer.drain()
+                if handler.close_connection:
+                    break
+        except ConnectionError:
+            pass
+        except Exception as e:
+            print(f"❌ Request error: {e}")
+        finally:
+            self.connections -= 1
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+            writer.close()
+
+    def _write_buffered(self, handler, writer):
+        """Send what a handler wrote while running on the loop thread itself"""
+        if handler.wfile.buffer:
+            writer.write(bytes(handler.wfile.buffer))
+            handler.wfile.buffer.clear()
+
+    def _make_handler(self, head, reader, writer, loop, requests_served=0, connection_buckets=None):
+        """Build a handler for one request without running BaseHTTPRequestHandler's socket loop"""
+        handler = self.RequestHandlerClass.__new__(self.RequestHandlerClass)
+        handler.upload_dir = "uploads"
+        handler.server = self
+        handler.client_address = writer.get_extra_info('peername') or ('', 0)
+        handler.request = None
+        handler.requests_served = requests_served
+        handler.route = None
+        handler.connection_buckets = connection_buckets or shaper.connection_buckets()
+        handler.rfile = io.BufferedReader(io.BytesIO(head))
+        handler.wfile = AsyncResponseWriter(writer, loop)
+        handler.close_connection = True
+        # parse_request() validates the request line and reads the headers
+        # from the buffered head; the body is then read from the socket
+        handler.raw_requestline = handler.rfile.readline(MAX_REQUEST_HEAD + 1)
+        parsed = handler.parse_request()
+        # Already on the loop, so whatever parse_request wrote (an error or
+        # "100 Continue") goes straight to the transport
+        self._write_buffered(handler, writer)
+        if not parsed:
+            if handler.route:
+                handler.record_request()
+            return None
+        handler.rfile.source = AsyncBodyReader(reader, loop)
+        return handler
+
+    def _run_handler(self, handler):
+        method = getattr(handler, 'do_' + handler.command, None)
+        try:
+            if method is None:
+                handler.send_error(501, f"Unsupported method ({handler.command!r})")
+            else:
+                method()
+            handler.finish_request_body()
+        except Exception:
+            handler.close_connection = True
+            raise
+        finally:
+            handler.wfile.finish()
+            handler.record_request()
+
 def get_local_ip():
     """Get the local IP address"""
     try:
@@ -632,7 +4022,130 @@ def get_local_ip():
     except Exception:
         return "127.0.0.1"
 
+def run_server(args, port, reuse_port=False):
+    """Start the background workers and serve until interrupted"""
+    # The codec pool forks its workers, so start it before any other thread
+    configure_codec_pool(args.codec_pool, args.codec_workers)
+    if codec_pool is not None:
+        print(f"⚙️ Codec pool: {args.codec_workers} {args.codec_pool} workers")
+    analytics.start()
+    # Stop on SIGTERM the same way as on Ctrl+C so queued analytics are written
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    expiry.start()
+
+    server = None
+    try:
+        if args.engine == 'asyncio':
+            # Every admitted request needs a handler thread, or light ones could queue behind bulk ones
+            workers = max(args.workers, sum(lane.workers for lane in scheduler.lanes.values()))
+            print(f"⚙️ asyncio engine with {workers} handler threads")
+            server = AsyncHTTPServer(('0.0.0.0', port), FileTransferHandler, workers=workers,
+                                     reuse_port=reuse_port)
+        else:
+            server = ThreadedHTTPServer(('0.0.0.0', port), FileTransferHandler, reuse_port=reuse_port)
+        metrics.register('gauge', 'bt_connections', 'Open client connections',
+                         collect=lambda: [((), server.connections)])
+        server.serve_forever()
+    except KeyboardInterrupt:
+        if server is not None:
+            server.shutdown()
+        analytics.close()
+
+def start_worker(args, port):
+    """Fork one prefork worker process. Returns its pid"""
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            run_server(args, port, reuse_port=True)
+        except BaseException as e:
+            print(f"❌ Worker {os.getpid()} failed: {e}")
+            status = 1
+        finally:
+            # Never fall back into the master's code
+            os._exit(status)
+    return pid
+
+def run_prefork(args, port):
+    """Run args.processes workers on one port and replace any that exit.
+
+    Each worker binds its own listening socket with SO_REUSEPORT, so the
+    kernel spreads connections across processes and no single interpreter's
+    GIL caps throughput. Everything they share lives on disk: the key file,
+    the SQLite catalog and analytics (WAL mode), upload sessions and blobs.
+    """
+    workers = set()
+    try:
+        for _ in range(args.processes):
+            workers.add(start_worker(args, port))
+        print(f"⚙️ Prefork: {args.processes} worker processes")
+        while True:
+            pid, status = os.wait()
+            workers.discard(pid)
+            print(f"⚠️ Worker {pid} exited with status {status}, restarting")
+            time.sleep(1)  # Do not spin if workers die on startup
+            workers.add(start_worker(args, port))
+    except KeyboardInterrupt:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in workers:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
 def main():
+    parser = argparse.ArgumentParser(description="B-Transfer file transfer server")
+    parser.add_argument('--migrate', action='store_true',
+                        help="convert stored files to the segmented format and exit")
+    parser.add_argument('--engine', choices=['threaded', 'asyncio'],
+                        default=os.environ.get('BT_ENGINE', 'threaded'),
+                        help="server engine (default: $BT_ENGINE or threaded)")
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('BT_WORKERS', 32)),
+                        help="handler threads for the asyncio engine (default: $BT_WORKERS or 32)")
+    parser.add_argument('--codec-pool', choices=['thread', 'process', 'off'],
+                        default=os.environ.get('BT_CODEC_POOL', 'thread' if (os.cpu_count() or 1) > 1 else 'off'),
+                        help="where compression and encryption run (default: $BT_CODEC_POOL, "
+                             "or thread when there is more than one CPU)")
+    parser.add_argument('--codec-workers', type=int,
+                        default=int(os.environ.get('BT_CODEC_WORKERS', os.cpu_count() or 1)),
+                        help="codec pool size (default: $BT_CODEC_WORKERS or the CPU count)")
+    parser.add_argument('--compression', choices=COMPRESSION_POLICIES,
+                        default=os.environ.get('BT_COMPRESSION', 'auto'),
+                        help="how hard to compress new files (default: $BT_COMPRESSION or auto)")
+    parser.add_argument('--processes', type=int, default=int(os.environ.get('BT_PROCESSES', 1)),
+                        help="worker processes sharing the port (default: $BT_PROCESSES or 1)")
+    parser.add_argument('--segment-cache-mb', type=float,
+                        default=float(os.environ.get('BT_SEGMENT_CACHE_MB', 256)),
+                        help="memory for decoded segments of hot files, 0 to disable "
+                             "(default: $BT_SEGMENT_CACHE_MB or 256)")
+    parser.add_argument('--rotate-key', action='store_true',
+                        help="add a new primary encryption key to the key file and exit")
+    args = parser.parse_args()
+    set_compression_policy(args.compression)
+    segment_cache.resize(int(args.segment_cache_mb * 1024 * 1024))
+
+    if args.rotate_key:
+        try:
+            new_key_id = rotate_key()
+        except ValueError as e:
+            parser.error(str(e))
+        print(f"🔑 New primary key {new_key_id} added to {KEY_FILE}; older keys stay for reading")
+        print("   Restart the server to use it, then run --migrate to re-encrypt old files")
+        return
+    if args.processes > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        parser.error("--processes needs SO_REUSEPORT, which this platform does not have")
+
+    if args.migrate:
+        os.makedirs('uploads', exist_ok=True)
+        migrated, failed = migrate_uploads('uploads')
+        catalog.sync('uploads')
+        print(f"✅ Migration finished: {migrated} migrated, {failed} failed")
+        return
+
     port = int(os.environ.get('PORT', 8081))  # Use Heroku's port or default to 8081
     local_ip = get_local_ip()
     
@@ -650,12 +4163,20 @@ def main():
     print("Press Ctrl+C to stop the server")
     print("")
     
-    try:
-        server = ThreadedHTTPServer(('0.0.0.0', port), FileTransferHandler)
-        server.serve_forever()
-    except KeyboardInterrupt:
-        print("\n\n🛑 B-Transfer server stopped. Thanks for using B-Transfer by Balsim Productions!")
-        server.shutdown()
+    print(f"📄 {load_static_assets()} app files loaded into memory")
+    # Pick up files added, changed or removed while the server was down
+    os.makedirs('uploads', exist_ok=True)
+    added, removed = catalog.sync('uploads')
+    if added or removed:
+        print(f"🗂️ File catalog updated: {added} added, {removed} removed")
+    
+    if args.processes > 1:
+        # The master only supervises; stop it (and its workers) with Ctrl+C or SIGTERM
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        run_prefork(args, port)
+    else:
+        run_server(args, port)
+    print("\n\n🛑 B-Transfer server stopped. Thanks for using B-Transfer by Balsim Productions!")
 
 if __name__ == '__main__':
     main()
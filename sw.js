@@ -48,9 +48,11 @@ self.addEventListener('fetch', (event) => {
     return;
   }
 
-  // Skip upload requests
+  // Skip uploads, the live file list and its change feed, and archives
   if (event.request.url.includes('/upload') || 
       event.request.url.includes('/delete') ||
+      event.request.url.includes('/files') ||
+      event.request.url.includes('/archive') ||
       event.request.method !== 'GET') {
     return;
   }
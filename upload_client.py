@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+B-Transfer - Command Line Uploader
+Uploads files with the resumable chunked protocol: chunks are sent in parallel,
+failed chunks are retried, and an interrupted upload picks up where it stopped
+the next time the same file is uploaded to the same server.
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+import http.client
+from urllib.parse import urlsplit, quote
+from concurrent.futures import ThreadPoolExecutor
+
+STATE_FILE = os.path.expanduser("~/.b-transfer-sessions.json")
+BUSY_RETRIES = 10  # Times a request turned away with 429/503 is sent again
+state_lock = threading.Lock()
+
+class UploadFailed(Exception):
+    pass
+
+class Server:
+    """Tiny HTTP client with one connection per thread"""
+
+    def __init__(self, url):
+        parts = urlsplit(url if "://" in url else f"http://{url}")
+        self.url = f"{parts.scheme}://{parts.netloc}"
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.local = threading.local()
+
+    def connection(self):
+        if getattr(self.local, "conn", None) is None:
+            conn_class = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+            self.local.conn = conn_class(self.netloc, timeout=120)
+        return self.local.conn
+
+    def request(self, method, path, body=None, headers=None):
+        """Return (status, headers, parsed JSON or None)
+
+        Requests the server turns away because it is busy (429/503) are sent
+        again after the Retry-After it asks for.
+        """
+        for attempt in range(BUSY_RETRIES + 1):
+            conn = self.connection()
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+                response = conn.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException):
+                # Drop the broken connection; the caller decides whether to retry
+                conn.close()
+                self.local.conn = None
+                raise
+            if response.status not in (429, 503) or attempt == BUSY_RETRIES:
+                break
+            try:
+                delay = int(response.headers.get("Retry-After", 5))
+            except ValueError:
+                delay = 5
+            time.sleep(min(max(delay, 1), 60))
+        try:
+            payload = json.loads(data) if data else None
+        except ValueError:
+            payload = None
+        return response.status, response.headers, payload
+
+def load_state():
+    try:
+        with open(STATE_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_state(state):
+    """Write the resume state; failing to only costs the ability to resume, so it just warns"""
+    with state_lock:
+        try:
+            os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+            with open(STATE_FILE, "w") as f:
+                json.dump(state, f)
+        except OSError as e:
+            print(f"⚠️ Could not save upload state to {STATE_FILE}: {e}")
+
+def state_key(server, path):
+    stat = os.stat(path)
+    return f"{server.url}|{os.path.abspath(path)}|{stat.st_size}|{int(stat.st_mtime)}"
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def open_session(server, path, state):
+    """Resume the saved session for this file if the server still has it, else start one
+
+    The file's sha256 is sent along so the server can skip the transfer when it
+    already stores the same content; the result is then the finished upload.
+    """
+    key = state_key(server, path)
+    session_id = state.get(key)
+    if session_id:
+        status, _, session = server.request("GET", f"/upload/sessions/{quote(session_id)}")
+        if status == 200:
+            return key, session
+
+    body = json.dumps({"filename": os.path.basename(path), "size": os.path.getsize(path),
+                       "sha256": file_sha256(path)})
+    status, _, session = server.request("POST", "/upload/sessions", body=body,
+                                        headers={"Content-Type": "application/json"})
+    if status == 200 and session.get("deduplicated"):
+        return key, session
+    if status != 201:
+        raise UploadFailed(f"could not create upload session (HTTP {status})")
+    state[key] = session["session_id"]
+    save_state(state)
+    return key, session
+
+def send_chunk(server, path, session, number, retries, progress):
+    offset = number * session["chunk_size"]
+    length = min(session["chunk_size"], session["size"] - offset)
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read(length)
+
+    for attempt in range(retries + 1):
+        try:
+            status, _, _ = server.request("PUT", f"/upload/sessions/{session['session_id']}?offset={offset}",
+                                          body=data, headers={"Content-Type": "application/octet-stream"})
+            if status == 200:
+                progress(length)
+                return
+            if status < 500:
+                raise UploadFailed(f"chunk at {offset} rejected (HTTP {status})")
+        except (OSError, http.client.HTTPException):
+            pass
+        time.sleep(min(2 ** attempt, 30))
+    raise UploadFailed(f"chunk at {offset} failed after {retries + 1} attempts")
+
+def upload(server, path, parallel, retries):
+    state = load_state()
+    key, session = open_session(server, path, state)
+    if session.get("deduplicated"):
+        print(f"⚡ {os.path.basename(path)}: already stored, linked without uploading")
+        return session
+    missing = session["missing_chunks"]
+    total = session["size"]
+    done = [total - sum(min(session["chunk_size"], total - n * session["chunk_size"]) for n in missing)]
+    lock = threading.Lock()
+
+    def progress(length):
+        with lock:
+            done[0] += length
+            percent = 100 * done[0] / total if total else 100
+            print(f"\r📤 {os.path.basename(path)}: {percent:5.1f}%", end="", flush=True)
+
+    if done[0]:
+        print(f"🔄 Resuming {os.path.basename(path)} ({len(missing)} of {session['chunk_count']} chunks left)")
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        futures = [pool.submit(send_chunk, server, path, session, n, retries, progress) for n in missing]
+        for future in futures:
+            future.result()
+    print()
+
+    status, _, result = server.request("POST", f"/upload/sessions/{session['session_id']}/finalize")
+    if status != 200:
+        raise UploadFailed(f"finalize failed (HTTP {status})")
+    state.pop(key, None)
+    save_state(state)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Upload files to a B-Transfer server")
+    parser.add_argument("files", nargs="+", help="files to upload")
+    parser.add_argument("--server", default=os.environ.get("B_TRANSFER_URL", "http://localhost:8081"),
+                        help="server URL (default: $B_TRANSFER_URL or http://localhost:8081)")
+    parser.add_argument("--parallel", type=int, default=4, help="chunks in flight at once (default: 4)")
+    parser.add_argument("--retries", type=int, default=5, help="retries per chunk (default: 5)")
+    args = parser.parse_args()
+
+    server = Server(args.server)
+    failed = False
+    for path in args.files:
+        try:
+            result = upload(server, path, max(1, args.parallel), args.retries)
+            print(f"✅ Uploaded {result['filename']} (owner token: {result['owner_token']})")
+        except (OSError, UploadFailed, http.client.HTTPException) as e:
+            print(f"\n❌ {path}: {e}")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()